@@ -1,5 +1,7 @@
 __version__ = "0.1.0"
 
+from importlib import import_module
+
 from extras.plugins import PluginConfig
 
 
@@ -12,7 +14,51 @@ class RouterOsConfig(PluginConfig):
     author_email = "adam.charnock@gardunha.net"
     base_url = "routeros"
     required_settings = []
-    default_settings = {}
+    middleware = ["netbox_routeros.middleware.DeferStaleMarkingMiddleware"]
+    default_settings = {
+        # Number of devices to fetch config from concurrently
+        "fetch_workers": 10,
+        # Seconds to wait for a single device before giving up on it
+        "fetch_timeout": 120,
+        # Number of devices to push config to concurrently
+        "push_workers": 10,
+        # Seconds to wait for a single device before giving up on it
+        "push_timeout": 300,
+        # Pushes happen in waves. The first (canary) wave contains this many
+        # devices, and each wave thereafter is this many times larger
+        "push_canary_size": 1,
+        "push_wave_growth": 4,
+        # Stop pushing once more than this fraction of devices have failed
+        "push_max_error_rate": 0.1,
+        # How to run fetch & push jobs. Either 'rq' (run on Netbox's RQ
+        # workers, using the job_queue queue), or 'thread' (run in a
+        # background thread within the web process)
+        "job_runner": "rq",
+        "job_queue": "default",
+        # Seconds a job may run for before RQ kills it, after which it is
+        # marked as failed. By default this is worked out from the number of
+        # devices and the fetch/push settings above
+        "job_timeout": None,
+        # Seconds an unused connection to a device is kept open for reuse.
+        # Set to 0 to close connections as soon as they are finished with.
+        # Only opened sessions are reused (see napalm_open_sessions). Without
+        # them, only the unopened driver object is kept, and every operation
+        # still connects & authenticates separately
+        "napalm_pool_idle_timeout": 60,
+        # Open a session with each device, so that the operations performed
+        # on it share one connection. With napalm-ros this requires the
+        # RouterOS API service to be enabled on every device. Otherwise,
+        # drivers are never opened, and connect as each operation needs to
+        "napalm_open_sessions": False,
+        # Seconds to cache generated configs for display. Cached configs are
+        # keyed on their inputs, so are re-rendered when those change
+        "render_cache_timeout": 86400,
+    }
+
+    def ready(self):
+        super().ready()
+        # Connects the signal handlers
+        import_module("netbox_routeros.signals")
 
 
 config = RouterOsConfig
@@ -0,0 +1,179 @@
+"""Benchmarks for the render, parse & diff pipeline
+
+Builds a synthetic fleet, then times each stage of producing every device's
+config. Run via ``manage.py routeros_benchmark``, which builds the fleet
+within a transaction that is rolled back afterwards.
+"""
+import platform
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from routeros_diff import RouterOSConfig
+
+import netbox_routeros
+from dcim.models import Device
+from netbox_routeros.render_data import DeviceRenderData, load_render_data
+from netbox_routeros.ros_config_maker import (
+    get_template,
+    make_ros_config_context,
+    render_ros_config,
+    render_ros_config_many,
+)
+from netbox_routeros.testing import DataProvider
+from netbox_routeros.utilities.parsed_config import PARSER_VERSION
+
+BENCHMARK_TEMPLATE_NAME = "_benchmark"
+
+BENCHMARK_TEMPLATE = """/interface vlan
+{% for vlan in vlans %}add name=vlan{{ vlan.vid }} vlan-id={{ vlan.vid }} interface=bridge
+{% endfor %}
+/ip address
+{% for ip in ip_addresses %}add address={{ ip.address }} interface={{ get_interface(ip, include_vlans=False) }}
+{% endfor %}
+/routing filter
+{% for prefix in combine_prefixes(prefixes) %}add chain=out prefix={{ prefix }} action=accept
+{% endfor %}
+/system identity
+set name={{ device.name }}
+"""
+
+
+def build_fleet(
+    devices: int, interfaces: int, prefixes: int, vlans: int
+) -> List[Device]:
+    """Create a synthetic fleet of devices
+
+    See DataProvider.fleet() for details of the fleet's topology.
+    """
+    return (
+        DataProvider()
+        .fleet(
+            devices=devices,
+            interfaces=interfaces,
+            prefixes=prefixes,
+            vlans=vlans,
+            name="benchmark",
+        )
+        .devices
+    )
+
+
+def run_benchmark(
+    devices: List[Device], template_content: str = BENCHMARK_TEMPLATE, repeat=3
+) -> dict:
+    """Time each stage of the pipeline for every device
+
+    The per-device stages are:
+
+    * context: loading the device's data from the database (its datasets,
+      config context & interface index), and building the template context
+    * render: rendering the template, which should need no further queries
+      unless the template makes its own
+    * parse & diff: parsing the rendered config, and diffing it against a
+      simulated fetched config
+
+    Returns a summary of the timings (in seconds), query counts (in total,
+    and during the render stage) and config sizes, suitable for serialising
+    as JSON.
+    """
+    samples: Dict[str, List[float]] = {
+        name: []
+        for name in (
+            "context",
+            "render",
+            "parse",
+            "diff",
+            "queries",
+            "render_queries",
+            "config_lines",
+        )
+    }
+    batch_samples: Dict[str, List[float]] = {"load_render_data": [], "render_many": []}
+
+    # Compile the template up front, so as not to time it
+    get_template(BENCHMARK_TEMPLATE_NAME, template_content)
+
+    for _ in range(repeat):
+        for device in devices:
+            render_data = DeviceRenderData(device)
+            with CaptureQueriesContext(connection) as queries:
+                with _timer(samples["context"]):
+                    # The data would otherwise be loaded lazily, and so be
+                    # timed as part of the render
+                    render_data.load_all()
+                    render_data.interface_index
+                    context = make_ros_config_context(device, render_data=render_data)
+                context_queries = len(queries)
+                with _timer(samples["render"]):
+                    config = render_ros_config(
+                        device,
+                        template_name=BENCHMARK_TEMPLATE_NAME,
+                        template_content=template_content,
+                        render_data=render_data,
+                        context=context,
+                    )
+            with _timer(samples["parse"]):
+                parsed = RouterOSConfig.parse(config)
+
+            old = RouterOSConfig.parse(_fetched_config(config))
+            with _timer(samples["diff"]):
+                parsed.diff(old, old_verbose=old)
+
+            samples["queries"].append(len(queries))
+            samples["render_queries"].append(len(queries) - context_queries)
+            samples["config_lines"].append(config.count("\n"))
+
+        with _timer(batch_samples["load_render_data"]):
+            load_render_data(devices)
+        with _timer(batch_samples["render_many"]):
+            render_ros_config_many(
+                devices,
+                template_name=BENCHMARK_TEMPLATE_NAME,
+                template_content=template_content,
+            )
+
+    return dict(
+        environment=dict(
+            python=platform.python_version(),
+            django=django.get_version(),
+            netbox_routeros=netbox_routeros.__version__,
+            parser=PARSER_VERSION,
+        ),
+        parameters=dict(devices=len(devices), repeat=repeat),
+        per_device={name: summarise(values) for name, values in samples.items()},
+        per_batch={name: summarise(values) for name, values in batch_samples.items()},
+    )
+
+
+def summarise(values: List[float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return dict(count=0)
+    return dict(
+        count=len(values),
+        total=round(sum(values), 6),
+        mean=round(statistics.mean(values), 6),
+        median=round(statistics.median(values), 6),
+        p95=round(values[int(0.95 * (len(values) - 1))], 6),
+        min=round(values[0], 6),
+        max=round(values[-1], 6),
+    )
+
+
+def _fetched_config(config: str) -> str:
+    """Simulate a config fetched from a device which has drifted somewhat"""
+    lines = config.splitlines()
+    lines = lines[: len(lines) * 3 // 4]
+    return "\n".join(lines + ["/system identity", "set name=drifted"])
+
+
+@contextmanager
+def _timer(samples: List[float]):
+    started = time.perf_counter()
+    yield
+    samples.append(time.perf_counter() - started)
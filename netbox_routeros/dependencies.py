@@ -0,0 +1,158 @@
+"""Track which configured devices are affected by changes to IPAM/DCIM data
+
+Each device's render_dependencies records what its last render depended
+upon (see ConfiguredDevice.check_drift() & RenderRecorder). The device is
+marked as stale when:
+
+* one of the objects its render used changes,
+* any object changes of a model which its template queried for itself, or
+* an object is created which is related to the device's own interfaces or
+  addresses, and so may be used by the device's next render.
+
+Only the stale devices then need rendering again (i.e. manage.py
+routeros_check_drift --stale). Only changes to the models in AFFECTED_BY
+are tracked.
+
+Within deferred_stale_marking() (which wraps every request, see
+DeferStaleMarkingMiddleware), changes are collected and the devices are
+marked once at the end. A bulk edit of many objects therefore runs one
+UPDATE per model, rather than one per object.
+"""
+import operator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import reduce
+from typing import Dict, Optional, Tuple
+
+from django.db.models import Model, Q
+from django.utils.timezone import now
+
+from dcim.models import Device, Interface
+from ipam.models import IPAddress, Prefix, VLAN
+from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice
+
+
+def mark_stale(condition: Q) -> int:
+    """Mark the devices matching condition as stale
+
+    Devices which are already stale keep their original stale_since.
+    """
+    pks = ConfiguredDevice.objects.filter(condition).values("pk")
+    return ConfiguredDevice.objects.filter(pk__in=pks, stale_since__isnull=True).update(
+        stale_since=now()
+    )
+
+
+# The conditions collected by deferred_stale_marking(), keyed on the
+# changed object's model & pk
+_deferred: ContextVar[Optional[Dict[Tuple[type, int], Q]]] = ContextVar(
+    "routeros_deferred_stale", default=None
+)
+
+
+def changed(model: type, instance: Model):
+    """Mark the devices affected by a change to instance as stale
+
+    Within deferred_stale_marking() this happens at the end instead. The
+    model's AFFECTED_BY function returns None if the change cannot affect
+    any device.
+    """
+    # Built now, as a deleted instance no longer has a pk by the end
+    condition = AFFECTED_BY[model](instance)
+    if condition is None:
+        return
+    deferred = _deferred.get()
+    if deferred is None:
+        mark_stale(condition)
+    else:
+        deferred[(model, instance.pk)] = condition
+
+
+@contextmanager
+def deferred_stale_marking():
+    """Mark devices stale once at the end, rather than for each change
+
+    Conditions are combined per model. Nothing is marked if an exception
+    is raised, as any changes will usually have been rolled back.
+    """
+    if _deferred.get() is not None:
+        # Already deferred by an outer call
+        yield
+        return
+
+    deferred = {}
+    token = _deferred.set(deferred)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+
+    by_model = {}
+    for (model, _), condition in deferred.items():
+        by_model.setdefault(model, []).append(condition)
+    for conditions in by_model.values():
+        mark_stale(reduce(operator.or_, conditions))
+
+
+def depends_on(instance: Model) -> Q:
+    """Match devices whose last render used the object, or its model
+
+    Containment is tested on the whole column, rather than on a path
+    within it, so that the GIN index on render_dependencies can be used.
+    """
+    label = instance._meta.label_lower
+    return Q(render_dependencies__contains={"objects": {label: [instance.pk]}}) | Q(
+        render_dependencies__contains={"models": [label]}
+    )
+
+
+def affected_by_ip_address(instance: IPAddress) -> Q:
+    # Either the address was used, or it is now assigned to the device
+    return depends_on(instance) | Q(device__interfaces__ip_addresses=instance.pk)
+
+
+def affected_by_prefix(instance: Prefix) -> Q:
+    # Either the prefix was used, or (perhaps now) covers one of the
+    # device's addresses
+    return depends_on(instance) | Q(
+        device__interfaces__ip_addresses__address__net_host_contained=str(
+            instance.prefix
+        )
+    )
+
+
+def affected_by_vlan(instance: VLAN) -> Q:
+    # A VLAN only becomes relevant to a device via a prefix, which is
+    # handled by affected_by_prefix()
+    return depends_on(instance)
+
+
+def affected_by_interface(instance: Interface) -> Q:
+    return depends_on(instance) | Q(device=instance.device_id)
+
+
+def affected_by_device(instance: Device) -> Q:
+    return depends_on(instance) | Q(device=instance.pk)
+
+
+def affected_by_configured_device(instance: ConfiguredDevice) -> Optional[Q]:
+    # i.e. its template or extra configuration was changed. Not when its
+    # fetched config is saved, say
+    if instance.render_inputs_changed():
+        return Q(pk=instance.pk)
+    return None
+
+
+def affected_by_configuration_template(instance: ConfigurationTemplate) -> Q:
+    return Q(configuration_template=instance.pk)
+
+
+AFFECTED_BY = {
+    IPAddress: affected_by_ip_address,
+    Prefix: affected_by_prefix,
+    VLAN: affected_by_vlan,
+    Interface: affected_by_interface,
+    Device: affected_by_device,
+    ConfiguredDevice: affected_by_configured_device,
+    ConfigurationTemplate: affected_by_configuration_template,
+}
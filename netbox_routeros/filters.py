@@ -1,3 +1,6 @@
+import django_filters
+from django.db.models import Q
+
 from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice
 from tenancy.filters import TenancyFilterSet
 from utilities.filters import BaseFilterSet, NameSlugSearchFilterSet
@@ -6,6 +9,8 @@ from utilities.filters import BaseFilterSet, NameSlugSearchFilterSet
 class ConfiguredDeviceFilterSet(
     BaseFilterSet, TenancyFilterSet, NameSlugSearchFilterSet
 ):
+    stale = django_filters.BooleanFilter(method="filter_stale", label="Stale")
+
     class Meta:
         # TODO: Include device fields
         model = ConfiguredDevice
@@ -14,8 +19,22 @@ class ConfiguredDeviceFilterSet(
             "configuration_template",
             "last_config_fetched_at",
             "last_config_pushed_at",
+            "in_sync",
         ]
 
+    def search(self, queryset, name, value):
+        # Configured devices have no name or slug of their own
+        if not value.strip():
+            return queryset
+        return queryset.filter(
+            Q(device__name__icontains=value)
+            | Q(configuration_template__name__icontains=value)
+            | Q(configuration_template__slug__icontains=value)
+        )
+
+    def filter_stale(self, queryset, name, value):
+        return queryset.filter(stale_since__isnull=not value)
+
 
 class ConfigurationTemplateFilterSet(
     BaseFilterSet, TenancyFilterSet, NameSlugSearchFilterSet
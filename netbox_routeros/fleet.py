@@ -0,0 +1,275 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, TYPE_CHECKING
+
+from django.db import connection
+
+from netbox_routeros.render_data import load_render_data
+from netbox_routeros.utilities.settings import get_plugin_setting
+
+if TYPE_CHECKING:
+    from netbox_routeros.models import ConfiguredDevice
+
+ResultCallback = Optional[Callable[["DeviceResult"], None]]
+
+# How often to check for devices which have exceeded their timeout
+POLL_INTERVAL = 0.5
+
+# How many devices to load render data for at once when checking drift
+DRIFT_BATCH_SIZE = 200
+
+
+@dataclass
+class DeviceResult:
+    """The outcome of running an operation against a single device"""
+
+    SUCCESS = "success"
+    FAILED = "failed"
+    # Still running after the timeout, so the outcome is not yet known
+    TIMEOUT = "timeout"
+    SKIPPED = "skipped"
+
+    configured_device: "ConfiguredDevice"
+    status: str = SKIPPED
+    error: str = ""
+    # Seconds spent on this device
+    duration: Optional[float] = None
+
+    @property
+    def success(self):
+        return self.status == self.SUCCESS
+
+
+def fetch_configs(
+    configured_devices: Iterable["ConfiguredDevice"],
+    workers: int = None,
+    timeout: float = None,
+    on_result: ResultCallback = None,
+) -> List[DeviceResult]:
+    """Fetch the config from many devices concurrently
+
+    Devices with problems are skipped. Returns one result per device, in the
+    order the devices were given.
+    """
+    return run_for_devices(
+        configured_devices,
+        operation=lambda configured_device: configured_device.fetch_config(),
+        workers=workers or get_plugin_setting("fetch_workers"),
+        timeout=timeout or get_plugin_setting("fetch_timeout"),
+        on_result=on_result,
+    )
+
+
+def push_configs(
+    configured_devices: Iterable["ConfiguredDevice"],
+    workers: int = None,
+    timeout: float = None,
+    canary_size: int = None,
+    wave_growth: int = None,
+    max_error_rate: float = None,
+    on_result: ResultCallback = None,
+) -> List[DeviceResult]:
+    """Push config to many devices concurrently, in waves of increasing size
+
+    A small canary wave is pushed first, and each subsequent wave is larger.
+    If the proportion of failed devices exceeds max_error_rate after any wave
+    then no further waves are pushed, and the remaining devices are reported
+    as skipped.
+    """
+    workers = workers or get_plugin_setting("push_workers")
+    timeout = timeout or get_plugin_setting("push_timeout")
+    canary_size = canary_size or get_plugin_setting("push_canary_size")
+    wave_growth = wave_growth or get_plugin_setting("push_wave_growth")
+    if max_error_rate is None:
+        max_error_rate = get_plugin_setting("push_max_error_rate")
+
+    configured_devices = list(configured_devices)
+    results = []
+    attempted = failed = 0
+    for wave in plan_waves(len(configured_devices), canary_size, wave_growth):
+        wave_devices = configured_devices[len(results) : len(results) + wave]
+        wave_results = run_for_devices(
+            wave_devices,
+            operation=lambda configured_device: configured_device.push_config(),
+            workers=workers,
+            timeout=timeout,
+            on_result=on_result,
+        )
+        results.extend(wave_results)
+
+        attempted += len([r for r in wave_results if r.status != r.SKIPPED])
+        # Devices which timed out have been waited for, so have their actual
+        # outcome by now
+        failed += len([r for r in wave_results if r.status == r.FAILED])
+        if attempted and failed / attempted > max_error_rate:
+            break
+
+    for configured_device in configured_devices[len(results) :]:
+        result = DeviceResult(
+            configured_device,
+            error=f"Not pushed as {failed} of {attempted} devices failed",
+        )
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    return results
+
+
+def check_drifts(
+    configured_devices: Iterable["ConfiguredDevice"], on_result: ResultCallback = None,
+) -> List[DeviceResult]:
+    """Update the drift summary of many devices
+
+    No connection to the devices is needed, only their last fetched
+    config, so devices are not skipped for having problems. Rendering is
+    CPU bound, so this is done in the current thread, and the devices'
+    render data is loaded in batches.
+    """
+    on_result = on_result or (lambda result: None)
+    configured_devices = list(configured_devices)
+    results = []
+    for start in range(0, len(configured_devices), DRIFT_BATCH_SIZE):
+        batch = configured_devices[start : start + DRIFT_BATCH_SIZE]
+        render_data = load_render_data([cd.device for cd in batch])
+        for configured_device in batch:
+            result = DeviceResult(configured_device)
+            started = time.monotonic()
+            try:
+                configured_device.check_drift(render_data[configured_device.device.pk])
+            except Exception as e:
+                result.status = DeviceResult.FAILED
+                result.error = f"{e.__class__.__name__}: {e}"
+            else:
+                result.status = DeviceResult.SUCCESS
+            result.duration = time.monotonic() - started
+            results.append(result)
+            on_result(result)
+    return results
+
+
+def plan_waves(total: int, canary_size: int, growth: int) -> List[int]:
+    """Get the size of each wave needed to push to total devices
+
+    For example, 100 devices with a canary size of 1 and a growth
+    of 4 gives waves of 1, 4, 16, 64 and 15 devices.
+    """
+    waves = []
+    size = max(canary_size, 1)
+    while total > 0:
+        waves.append(min(size, total))
+        total -= size
+        size *= max(growth, 1)
+    return waves
+
+
+def run_for_devices(
+    configured_devices: Iterable["ConfiguredDevice"],
+    operation: Callable[["ConfiguredDevice"], None],
+    workers: int,
+    timeout: float,
+    on_result: ResultCallback = None,
+) -> List[DeviceResult]:
+    """Run operation against each device using a pool of worker threads
+
+    A device which takes longer than timeout is reported as timed out, so a
+    slow or unreachable device cannot hold up the results of the rest of the
+    batch. Its outcome is unknown at that point, as its thread cannot be
+    killed. The operation continues until it finishes or the NAPALM timeout
+    for the device expires. This waits for it before returning, at which
+    point it is reported again with its actual outcome. Nothing which
+    follows (such as the next wave of pushes) therefore overlaps with it.
+
+    If given, on_result is called (from the calling thread) as soon as
+    each device's result is known.
+    """
+    on_result = on_result or (lambda result: None)
+    results = []
+    runnable = []
+    for configured_device in configured_devices:
+        result = DeviceResult(configured_device)
+        results.append(result)
+        if configured_device.problems:
+            result.error = "; ".join(configured_device.problems)
+            on_result(result)
+        else:
+            runnable.append(result)
+
+    if not runnable:
+        return results
+
+    started_at = {}
+
+    def _run(result: DeviceResult):
+        started_at[id(result)] = time.monotonic()
+        try:
+            operation(result.configured_device)
+        finally:
+            # Each worker thread gets its own database connection, which
+            # Django will not clean up for us
+            connection.close()
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(workers, len(runnable)), thread_name_prefix="routeros-device",
+    )
+    futures = {executor.submit(_run, result): result for result in runnable}
+    pending = set(futures)
+    timed_out = set()
+    try:
+        while pending:
+            done, pending = wait(
+                pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED
+            )
+            now = time.monotonic()
+
+            for future in done:
+                result = futures[future]
+                result.duration = now - started_at[id(result)]
+                try:
+                    future.result()
+                except Exception as e:
+                    result.status = DeviceResult.FAILED
+                    result.error = f"{e.__class__.__name__}: {e}"
+                else:
+                    result.status = DeviceResult.SUCCESS
+                on_result(result)
+
+            for future in list(pending):
+                result = futures[future]
+                started = started_at.get(id(result))
+                if started is not None and now - started > timeout:
+                    result.status = DeviceResult.TIMEOUT
+                    result.error = (
+                        f"Still running after {timeout} seconds. The outcome "
+                        f"will be reported once it finishes"
+                    )
+                    result.duration = now - started
+                    pending.discard(future)
+                    timed_out.add(future)
+                    on_result(result)
+
+        for future in as_completed(timed_out):
+            result = futures[future]
+            result.duration = time.monotonic() - started_at[id(result)]
+            try:
+                future.result()
+            except Exception as e:
+                result.status = DeviceResult.FAILED
+                result.error = (
+                    f"{e.__class__.__name__}: {e} (after exceeding the "
+                    f"{timeout} second timeout)"
+                )
+            else:
+                result.status = DeviceResult.SUCCESS
+                result.error = f"Succeeded after exceeding the {timeout} second timeout"
+            on_result(result)
+    finally:
+        for future in futures:
+            future.cancel()
+        # Never leave operations running in the background, as they could
+        # overlap with whatever runs next, or be killed part way through
+        # should the process exit
+        executor.shutdown(wait=True)
+
+    return results
@@ -3,12 +3,14 @@ from django import forms
 from dcim.models import Device
 from extras.models import Tag
 from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice
-from tenancy.forms import TenancyForm
+from tenancy.forms import TenancyFilterForm, TenancyForm
 from utilities.forms import (
+    BOOLEAN_WITH_BLANK_CHOICES,
     BootstrapMixin,
     DynamicModelMultipleChoiceField,
     SlugField,
     DynamicModelChoiceField,
+    StaticSelect2,
 )
 
 TEMPLATE_PLACEHOLDER = (
@@ -34,6 +36,27 @@ class ConfiguredDeviceForm(BootstrapMixin, TenancyForm, forms.ModelForm):
         ]
 
 
+class ConfiguredDeviceFilterForm(BootstrapMixin, TenancyFilterForm, forms.Form):
+    model = ConfiguredDevice
+    q = forms.CharField(required=False, label="Search")
+    device = DynamicModelChoiceField(
+        queryset=Device.objects.all(), display_field="display_name", required=False,
+    )
+    configuration_template = DynamicModelChoiceField(
+        queryset=ConfigurationTemplate.objects.all(), required=False,
+    )
+    in_sync = forms.NullBooleanField(
+        required=False,
+        label="In sync with template",
+        widget=StaticSelect2(choices=BOOLEAN_WITH_BLANK_CHOICES),
+    )
+    stale = forms.NullBooleanField(
+        required=False,
+        label="Changed since last check",
+        widget=StaticSelect2(choices=BOOLEAN_WITH_BLANK_CHOICES),
+    )
+
+
 class ConfigurationTemplateForm(BootstrapMixin, TenancyForm, forms.ModelForm):
     slug = SlugField()
     tags = DynamicModelMultipleChoiceField(queryset=Tag.objects.all(), required=False)
@@ -0,0 +1,259 @@
+"""In-memory indexes which answer template function lookups without queries
+
+Each index is built once, using a fixed number of queries, and is then
+consulted for every lookup made during a render.
+"""
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import netaddr
+from django.db.models import Count, F, Max
+
+from dcim.models import Device, Interface
+from ipam.models import IPAddress, Prefix, VLAN
+
+# Used to look up prefixes in any VRF
+ANY_VRF = object()
+
+# The process-wide prefix index. See get_prefix_index()
+_prefix_index: Optional["PrefixIndex"] = None
+_prefix_index_lock = threading.Lock()
+
+
+class InterfaceIndex:
+    """A device's interfaces, their addresses, and their VLANs
+
+    Used by get_interface(). See DeviceRenderData.interface_index.
+    """
+
+    def __init__(
+        self,
+        interfaces: Iterable[Interface],
+        ip_addresses: Iterable[IPAddress],
+        tagged_vlans: Iterable[Tuple[VLAN, List[netaddr.IPNetwork]]],
+    ):
+        # In the same order as the database returns them
+        self.interfaces: List[Interface] = list(interfaces)
+        interfaces_by_pk = {interface.pk: interface for interface in self.interfaces}
+
+        self.addresses: List[Tuple[netaddr.IPNetwork, Interface]] = [
+            (ip.address, interfaces_by_pk[ip.assigned_object_id])
+            for ip in ip_addresses
+            if ip.assigned_object_id in interfaces_by_pk
+        ]
+
+        # VLAN pk -> Interfaces the VLAN is tagged or untagged on
+        self.vlan_interfaces: Dict[int, List[Interface]] = defaultdict(list)
+        for interface in self.interfaces:
+            vlan_pks = {vlan.pk for vlan in interface.tagged_vlans.all()}
+            if interface.untagged_vlan_id:
+                vlan_pks.add(interface.untagged_vlan_id)
+            for vlan_pk in vlan_pks:
+                self.vlan_interfaces[vlan_pk].append(interface)
+
+        # The VLANs tagged on any interface, along with their prefixes
+        self.tagged_vlans: List[Tuple[VLAN, List[netaddr.IPNetwork]]] = list(
+            tagged_vlans
+        )
+
+    def get_vlan_interface(self, vlan: VLAN) -> Optional[Interface]:
+        """Get the first interface the VLAN is tagged or untagged on"""
+        interfaces = self.vlan_interfaces.get(vlan.pk)
+        return interfaces[0] if interfaces else None
+
+    def get_tagged_vlan(self, network: netaddr.IPNetwork) -> Optional[VLAN]:
+        """Get the last tagged VLAN with a prefix containing (or equal to) network"""
+        found = None
+        for vlan, prefixes in self.tagged_vlans:
+            for prefix in prefixes:
+                if prefix.prefixlen <= network.prefixlen and network.ip in prefix:
+                    found = vlan
+                    break
+        return found
+
+    def get_address_interface(self, network: netaddr.IPNetwork) -> Optional[Interface]:
+        """Get the interface with the most specific address matching network
+
+        For a host network (i.e. a /32) an address matches if it is the same
+        host. Otherwise, an address matches if it is within the network.
+        """
+        host = network.prefixlen == _width(network)
+        found = None
+        found_prefixlen = -1
+        for address, interface in self.addresses:
+            if host:
+                matches = address.ip == network.ip
+            else:
+                matches = (
+                    address.prefixlen >= network.prefixlen and address.ip in network
+                )
+            if matches and address.prefixlen >= found_prefixlen:
+                found = interface
+                found_prefixlen = address.prefixlen
+        return found
+
+
+def load_interface_indexes(
+    devices: Iterable[Device], ip_addresses: Dict[int, List[IPAddress]]
+) -> Dict[int, InterfaceIndex]:
+    """Build the interface index of many devices, keyed by device pk
+
+    Uses four queries, however many devices there are. ip_addresses are
+    each device's addresses, keyed by device pk.
+    """
+    devices = {device.pk: device for device in devices}
+
+    interfaces = defaultdict(list)
+    for interface in Interface.objects.filter(
+        device__in=list(devices)
+    ).prefetch_related("tagged_vlans"):
+        # As device.interfaces would, so the device is not queried again
+        interface.device = devices[interface.device_id]
+        interfaces[interface.device_id].append(interface)
+
+    tagged_vlans = defaultdict(list)
+    vlans = (
+        VLAN.objects.filter(interfaces_as_tagged__device__in=list(devices))
+        .annotate(_device_id=F("interfaces_as_tagged__device"))
+        .distinct()
+        .prefetch_related("prefixes")
+    )
+    for vlan in vlans:
+        tagged_vlans[vlan._device_id].append(
+            (vlan, [prefix.prefix for prefix in vlan.prefixes.all()])
+        )
+
+    return {
+        device.pk: InterfaceIndex(
+            interfaces[device.pk],
+            ip_addresses.get(device.pk, []),
+            tagged_vlans[device.pk],
+        )
+        for device in devices.values()
+    }
+
+
+class VlanAddressIndex:
+    """The first of a device's addresses within each VLAN's prefixes
+
+    Used by get_address(). See DeviceRenderData.vlan_address_index.
+    """
+
+    def __init__(
+        self,
+        ip_addresses: Iterable[IPAddress],
+        vlan_prefixes: Iterable[Tuple[int, netaddr.IPNetwork]],
+    ):
+        # (version, prefix length, network's first address) -> VLAN pks
+        vlans_by_network = defaultdict(set)
+        for vlan_id, prefix in vlan_prefixes:
+            vlans_by_network[(prefix.version, prefix.prefixlen, prefix.first)].add(
+                vlan_id
+            )
+
+        # VLAN pk -> address. Addresses are given in the same order as
+        # the database returns them, so the first match is kept
+        self.addresses: Dict[int, IPAddress] = {}
+        for ip_address in ip_addresses:
+            for vlan_id in _covering_vlans(vlans_by_network, ip_address.address):
+                self.addresses.setdefault(vlan_id, ip_address)
+
+    def get_address(self, vlan: VLAN) -> Optional[IPAddress]:
+        return self.addresses.get(vlan.pk)
+
+
+class PrefixIndex:
+    """Every prefix, for finding the most specific prefix covering an address
+
+    Prefixes are stored by VRF, IP version & prefix length, so a lookup
+    needs at most one dictionary lookup per prefix length in use. Only
+    prefix pks are stored, to keep the index small for large IPAM tables.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[int, netaddr.IPNetwork, Optional[int]]]):
+        # (vrf id, version) -> prefix length -> network's first address -> pk
+        networks = defaultdict(lambda: defaultdict(dict))
+        for pk, prefix, vrf_id in rows:
+            networks[(vrf_id, prefix.version)][prefix.prefixlen][prefix.first] = pk
+        self._networks: Dict[tuple, Dict[int, Dict[int, int]]] = {
+            key: dict(by_prefixlen) for key, by_prefixlen in networks.items()
+        }
+        # The prefix lengths in use, most specific first
+        self._prefixlens = {
+            key: sorted(networks, reverse=True)
+            for key, networks in self._networks.items()
+        }
+        # Identifies the data the index was built from. See get_prefix_index()
+        self.token = None
+
+    def get_covering(self, network: netaddr.IPNetwork, vrf_id=ANY_VRF) -> Optional[int]:
+        """Get the pk of the most specific prefix containing (or equal to) network
+
+        Searches all VRFs unless a vrf_id is given. A vrf_id of None searches
+        only the global table.
+        """
+        width = _width(network)
+        found = None
+        found_prefixlen = -1
+        for (key_vrf_id, version), networks in self._networks.items():
+            if version != network.version:
+                continue
+            if vrf_id is not ANY_VRF and key_vrf_id != vrf_id:
+                continue
+            for prefixlen in self._prefixlens[(key_vrf_id, version)]:
+                if prefixlen <= found_prefixlen:
+                    break
+                if prefixlen > network.prefixlen:
+                    continue
+                host_bits = width - prefixlen
+                pk = networks[prefixlen].get(network.value >> host_bits << host_bits)
+                if pk is not None:
+                    found = pk
+                    found_prefixlen = prefixlen
+                    break
+        return found
+
+
+def get_prefix_index() -> PrefixIndex:
+    """Get the index of every prefix, (re)building it if needed
+
+    The index is shared by the whole process. It is rebuilt if any prefix
+    has been created, changed or deleted since it was built. Changes within
+    this process are detected by a signal (see invalidate_prefix_index()),
+    whereas changes by other processes are detected by the number of prefixes
+    and their most recent modification time, which costs a single query.
+    """
+    global _prefix_index
+    token = tuple(
+        Prefix.objects.aggregate(
+            count=Count("pk"), last_updated=Max("last_updated")
+        ).values()
+    )
+    with _prefix_index_lock:
+        if _prefix_index is None or _prefix_index.token != token:
+            _prefix_index = PrefixIndex(
+                Prefix.objects.values_list("pk", "prefix", "vrf_id").iterator()
+            )
+            _prefix_index.token = token
+        return _prefix_index
+
+
+def invalidate_prefix_index():
+    """Forget the prefix index following a change to a prefix"""
+    global _prefix_index
+    with _prefix_index_lock:
+        _prefix_index = None
+
+
+def _covering_vlans(vlans_by_network: dict, address: netaddr.IPNetwork):
+    """Find the VLANs with a prefix containing (or equal to) the address"""
+    width = _width(address)
+    for prefixlen in range(0, address.prefixlen + 1):
+        host_bits = width - prefixlen
+        first = address.value >> host_bits << host_bits
+        yield from vlans_by_network.get((address.version, prefixlen, first), ())
+
+
+def _width(network: netaddr.IPNetwork) -> int:
+    return 32 if network.version == 4 else 128
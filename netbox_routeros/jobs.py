@@ -0,0 +1,181 @@
+import math
+import threading
+import traceback
+from datetime import timedelta
+from typing import Iterable
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils.timezone import now
+from django_rq import get_queue
+
+from netbox_routeros.fleet import (
+    check_drifts,
+    fetch_configs,
+    plan_waves,
+    push_configs,
+    DeviceResult,
+)
+from netbox_routeros.models import ConfigJob, ConfigJobDevice, ConfiguredDevice
+from netbox_routeros.utilities.settings import get_plugin_setting
+
+# Added to the timeout of every job, for its setup & the like
+JOB_TIMEOUT_MARGIN = 300
+
+# Allowed for rendering each device when checking drift
+DRIFT_SECONDS_PER_DEVICE = 10
+
+
+def create_config_job(
+    kind: str, configured_devices: Iterable[ConfiguredDevice], user=None
+) -> ConfigJob:
+    """Create a job to fetch config, push config or check drift, and queue
+    it to be run"""
+    job = ConfigJob.objects.create(kind=kind, user=user)
+    ConfigJobDevice.objects.bulk_create(
+        [
+            ConfigJobDevice(job=job, configured_device=configured_device)
+            for configured_device in configured_devices
+        ]
+    )
+    enqueue_config_job(job)
+    return job
+
+
+def enqueue_config_job(job: ConfigJob):
+    """Queue the job to be run once the current transaction commits
+
+    The job_runner setting determines how the job is run. Use 'rq' to
+    run it on Netbox's RQ workers, or 'thread' to run it within the
+    current process (which is useful for development & testing).
+    """
+    runner = get_plugin_setting("job_runner")
+    if runner == "rq":
+        queue = get_queue(get_plugin_setting("job_queue"))
+        job_timeout = math.ceil(get_job_timeout(job.kind, job.devices.count()))
+        transaction.on_commit(
+            lambda: queue.enqueue(run_config_job, job.pk, job_timeout=job_timeout)
+        )
+    elif runner == "thread":
+        thread = threading.Thread(
+            target=_run_config_job_in_thread,
+            args=(job.pk,),
+            name=f"routeros-job-{job.pk}",
+            daemon=True,
+        )
+        transaction.on_commit(thread.start)
+    else:
+        raise ImproperlyConfigured(
+            f"Unknown netbox_routeros job_runner '{runner}'. Use 'rq' or 'thread'."
+        )
+
+
+def get_job_timeout(kind: str, device_count: int) -> float:
+    """Get the seconds a job may take before it is assumed to have died
+
+    This is the job_timeout setting if set. Otherwise it is the longest the
+    job could take were every device to take its full timeout, plus
+    JOB_TIMEOUT_MARGIN.
+    """
+    if get_plugin_setting("job_timeout"):
+        return get_plugin_setting("job_timeout")
+
+    if kind == ConfigJob.KIND_FETCH:
+        # Each worker handles its share of the devices in turn
+        rounds = math.ceil(device_count / get_plugin_setting("fetch_workers"))
+        duration = rounds * get_plugin_setting("fetch_timeout")
+    elif kind == ConfigJob.KIND_PUSH:
+        # Each wave is waited for before the next starts
+        waves = plan_waves(
+            device_count,
+            get_plugin_setting("push_canary_size"),
+            get_plugin_setting("push_wave_growth"),
+        )
+        workers = get_plugin_setting("push_workers")
+        duration = sum(math.ceil(wave / workers) for wave in waves) * (
+            get_plugin_setting("push_timeout")
+        )
+    else:
+        # No device is contacted, only rendered
+        duration = device_count * DRIFT_SECONDS_PER_DEVICE
+    return duration + JOB_TIMEOUT_MARGIN
+
+
+def fail_stuck_jobs(jobs=None) -> int:
+    """Mark running jobs which have exceeded their timeout as failed
+
+    A job is killed without warning if it exceeds its timeout (or if its
+    worker dies), and so cannot record that it failed. Checks jobs (a
+    ConfigJob queryset), or all jobs if not given. Returns the number of
+    jobs marked as failed.
+    """
+    jobs = ConfigJob.objects.all() if jobs is None else jobs
+    stuck = 0
+    for job in jobs.filter(status=ConfigJob.STATUS_RUNNING).annotate(
+        device_count=Count("devices")
+    ):
+        timeout = get_job_timeout(job.kind, job.device_count)
+        if job.started_at + timedelta(seconds=timeout) < now():
+            job.status = ConfigJob.STATUS_FAILED
+            job.error = (
+                f"The job did not finish within {timeout:.0f} seconds, so was "
+                f"most likely killed"
+            )
+            job.completed_at = now()
+            job.save()
+            stuck += 1
+    return stuck
+
+
+def run_config_job(job_pk: int):
+    """Run a config job, recording each device's progress as it completes"""
+    fail_stuck_jobs()
+    job = ConfigJob.objects.get(pk=job_pk)
+    job_devices = {
+        job_device.configured_device_id: job_device
+        for job_device in job.devices.select_related(
+            "configured_device__configuration_template",
+            "configured_device__device__platform",
+            "configured_device__device__primary_ip4",
+            "configured_device__device__primary_ip6",
+        )
+    }
+
+    job.status = ConfigJob.STATUS_RUNNING
+    job.started_at = now()
+    job.save()
+
+    def on_result(result: DeviceResult):
+        job_device = job_devices[result.configured_device.pk]
+        job_device.status = result.status
+        job_device.error = result.error
+        job_device.duration = result.duration
+        job_device.completed_at = now()
+        job_device.save()
+
+    operation = {
+        ConfigJob.KIND_FETCH: fetch_configs,
+        ConfigJob.KIND_PUSH: push_configs,
+        ConfigJob.KIND_DRIFT: check_drifts,
+    }[job.kind]
+    try:
+        operation(
+            [job_device.configured_device for job_device in job_devices.values()],
+            on_result=on_result,
+        )
+    except Exception:
+        job.status = ConfigJob.STATUS_FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = ConfigJob.STATUS_COMPLETED
+
+    job.completed_at = now()
+    job.save()
+
+
+def _run_config_job_in_thread(job_pk: int):
+    try:
+        run_config_job(job_pk)
+    finally:
+        connection.close()
@@ -0,0 +1,69 @@
+import json
+from pathlib import Path
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from netbox_routeros.benchmark import build_fleet, run_benchmark, BENCHMARK_TEMPLATE
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark rendering, parsing and diffing configs for a synthetic fleet, "
+        "and output the results as JSON. The fleet is created within a transaction "
+        "which is rolled back once done, but do not run this against a production "
+        "database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=10)
+        parser.add_argument(
+            "--interfaces", type=int, default=8, help="Interfaces per device"
+        )
+        parser.add_argument(
+            "--prefixes", type=int, default=4, help="Prefixes per device"
+        )
+        parser.add_argument("--vlans", type=int, default=2, help="VLANs per device")
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="Times to render each device"
+        )
+        parser.add_argument(
+            "--template",
+            type=Path,
+            help="A file containing the template to render. Defaults to a "
+            "template which uses each of the generated datasets",
+        )
+        parser.add_argument(
+            "--output", type=Path, help="Write the results to this file"
+        )
+
+    def handle(self, *args, **options):
+        template_content = (
+            options["template"].read_text()
+            if options["template"]
+            else BENCHMARK_TEMPLATE
+        )
+
+        with transaction.atomic():
+            devices = build_fleet(
+                devices=options["devices"],
+                interfaces=options["interfaces"],
+                prefixes=options["prefixes"],
+                vlans=options["vlans"],
+            )
+            results = run_benchmark(
+                devices, template_content=template_content, repeat=options["repeat"]
+            )
+            transaction.set_rollback(True)
+
+        results["parameters"].update(
+            interfaces=options["interfaces"],
+            prefixes=options["prefixes"],
+            vlans=options["vlans"],
+            template=str(options["template"] or "default"),
+        )
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            options["output"].write_text(output + "\n")
+        else:
+            self.stdout.write(output)
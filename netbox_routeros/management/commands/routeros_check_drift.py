@@ -0,0 +1,48 @@
+from django.core.management import BaseCommand
+
+from netbox_routeros.fleet import check_drifts, DeviceResult
+from netbox_routeros.models import ConfiguredDevice
+
+
+class Command(BaseCommand):
+    help = (
+        "Update the drift summary for configured devices. Run this periodically "
+        "(i.e. from cron) to keep the 'in sync' column of the device list current."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--template",
+            action="append",
+            default=[],
+            help="Only check devices using the configuration template with this slug",
+        )
+        parser.add_argument(
+            "--stale",
+            action="store_true",
+            help="Only check devices whose data has changed since they were last checked",
+        )
+
+    def handle(self, *args, **options):
+        configured_devices = ConfiguredDevice.objects.select_related(
+            "configuration_template", "device"
+        )
+        if options["template"]:
+            configured_devices = configured_devices.filter(
+                configuration_template__slug__in=options["template"]
+            )
+        if options["stale"]:
+            configured_devices = configured_devices.filter(stale_since__isnull=False)
+
+        def on_result(result: DeviceResult):
+            if not result.success:
+                self.stderr.write(f"{result.configured_device}: {result.error}")
+
+        results = check_drifts(configured_devices, on_result=on_result)
+
+        in_sync = len([r for r in results if r.configured_device.in_sync])
+        drifted = len([r for r in results if r.configured_device.in_sync is False])
+        self.stdout.write(
+            f"Checked {len(results)} devices: {in_sync} in sync, {drifted} drifted, "
+            f"{len(results) - in_sync - drifted} unknown"
+        )
@@ -0,0 +1,16 @@
+from netbox_routeros.dependencies import deferred_stale_marking
+
+
+class DeferStaleMarkingMiddleware:
+    """Mark the devices affected by a request's changes as stale once, at the end
+
+    Bulk imports, edits & deletes save many objects in one request, and
+    would otherwise run an UPDATE of the configured devices for each.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with deferred_stale_marking():
+            return self.get_response(request)
@@ -0,0 +1,108 @@
+# Generated by Django 3.1.3 on 2026-10-18 09:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("netbox_routeros", "0005_auto_20210318_1441"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ConfigJob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("fetch", "Fetch config"), ("push", "Push config")],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("running", "Running"),
+                            ("completed", "Completed"),
+                            ("failed", "Failed"),
+                        ],
+                        default="pending",
+                        max_length=20,
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "started_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                (
+                    "completed_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                ("error", models.TextField(blank=True, default="")),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={"ordering": ["-created"],},
+        ),
+        migrations.CreateModel(
+            name="ConfigJobDevice",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False
+                    ),
+                ),
+                ("status", models.CharField(default="pending", max_length=20)),
+                ("error", models.TextField(blank=True, default="")),
+                (
+                    "duration",
+                    models.FloatField(
+                        blank=True, default=None, help_text="Seconds", null=True
+                    ),
+                ),
+                (
+                    "completed_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                (
+                    "configured_device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="jobs",
+                        to="netbox_routeros.configureddevice",
+                    ),
+                ),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="devices",
+                        to="netbox_routeros.configjob",
+                    ),
+                ),
+            ],
+            options={"ordering": ["job", "configured_device__device__name"],},
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.3 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("netbox_routeros", "0006_configjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="configureddevice",
+            name="last_config_parsed",
+            field=models.BinaryField(
+                blank=True, default=None, editable=False, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="last_verbose_config_parsed",
+            field=models.BinaryField(
+                blank=True, default=None, editable=False, null=True
+            ),
+        ),
+    ]
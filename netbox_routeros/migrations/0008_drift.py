@@ -0,0 +1,67 @@
+# Generated by Django 3.1.3 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("netbox_routeros", "0007_parsed_configs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="configureddevice",
+            name="in_sync",
+            field=models.BooleanField(
+                blank=True, db_index=True, default=None, editable=False, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="drift_commands",
+            field=models.PositiveIntegerField(
+                blank=True,
+                default=None,
+                editable=False,
+                help_text="The number of commands needed to bring the device in sync",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="drift_sections",
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="drift_hash",
+            field=models.CharField(
+                blank=True, default="", editable=False, max_length=64
+            ),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="drift_error",
+            field=models.TextField(blank=True, default="", editable=False),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="drift_checked_at",
+            field=models.DateTimeField(
+                blank=True, default=None, editable=False, null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="configjob",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("fetch", "Fetch config"),
+                    ("push", "Push config"),
+                    ("drift", "Check drift"),
+                ],
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.3 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("netbox_routeros", "0008_drift"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="configureddevice",
+            name="render_dependencies",
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name="configureddevice",
+            name="stale_since",
+            field=models.DateTimeField(
+                blank=True, db_index=True, default=None, editable=False, null=True
+            ),
+        ),
+    ]
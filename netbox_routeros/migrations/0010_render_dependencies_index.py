@@ -0,0 +1,22 @@
+# Generated by Django 3.1.3 on 2026-10-18 16:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("netbox_routeros", "0009_render_dependencies"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="configureddevice",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["render_dependencies"],
+                name="routeros_render_deps_gin",
+                opclasses=["jsonb_path_ops"],
+            ),
+        ),
+    ]
@@ -1,17 +1,23 @@
+import hashlib
 from typing import Optional
 
-import napalm
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.urls import reverse
 from django.utils.functional import cached_property
 from django.utils.timezone import now
-from napalm.base import ModuleImportError
 from routeros_diff import RouterOSConfig
 from taggit.managers import TaggableManager
 
 from extras.models import ChangeLoggedModel, TaggedItem
-from netbox.api.exceptions import ServiceUnavailable
-from netbox_routeros.ros_config_maker import render_ros_config
-from netbox_routeros.utilities.napalm import get_napalm_driver
+from netbox_routeros.render_data import DeviceRenderData
+from netbox_routeros.render_profiler import RenderProfiler, profile_stage
+from netbox_routeros.render_recorder import RenderRecorder
+from netbox_routeros.ros_config_maker import get_templates_version, render_ros_config
+from netbox_routeros.utilities.cache import get_or_compute
+from netbox_routeros.utilities.napalm import napalm_session
+from netbox_routeros.utilities.parsed_config import dump_config, load_config
 from utilities.querysets import RestrictedQuerySet
 
 
@@ -55,13 +61,64 @@ class ConfiguredDevice(ChangeLoggedModel):
         verbose_name="The last config which was fetched from the device (the verbose version)",
     )
     last_config_fetched_at = models.DateTimeField(default=None, null=True, blank=True)
+    # The above configs in parsed form, so they need not be parsed every time
+    # they are used. See utilities.parsed_config
+    last_config_parsed = models.BinaryField(
+        default=None, null=True, blank=True, editable=False
+    )
+    last_verbose_config_parsed = models.BinaryField(
+        default=None, null=True, blank=True, editable=False
+    )
 
     last_config_pushed_at = models.DateTimeField(default=None, null=True, blank=True)
 
+    # A summary of how the device's last fetched config differs from its
+    # template, so the device list can show & filter on it without rendering
+    # each device. Updated by check_drift()
+    in_sync = models.BooleanField(
+        default=None, null=True, blank=True, db_index=True, editable=False
+    )
+    drift_commands = models.PositiveIntegerField(
+        default=None,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="The number of commands needed to bring the device in sync",
+    )
+    drift_sections = models.JSONField(default=list, blank=True, editable=False)
+    drift_hash = models.CharField(max_length=64, default="", blank=True, editable=False)
+    drift_error = models.TextField(default="", blank=True, editable=False)
+    drift_checked_at = models.DateTimeField(
+        default=None, null=True, blank=True, editable=False
+    )
+    # What the last check_drift() render depended upon (see RenderRecorder),
+    # and when any of it subsequently changed. See netbox_routeros.dependencies
+    render_dependencies = models.JSONField(default=dict, blank=True, editable=False)
+    stale_since = models.DateTimeField(
+        default=None, null=True, blank=True, db_index=True, editable=False
+    )
+
+    # The fields which change what is rendered for the device
+    RENDER_FIELDS = ("configuration_template_id", "extra_configuration")
+
+    # Each fetched config field, and the field holding its parsed form
+    PARSED_FIELDS = (
+        ("last_config_fetched", "last_config_parsed"),
+        ("last_verbose_config_fetched", "last_verbose_config_parsed"),
+    )
+
     objects = RestrictedQuerySet.as_manager()
 
     class Meta:
         ordering = ["device__name"]
+        indexes = [
+            # For the containment queries of netbox_routeros.dependencies
+            GinIndex(
+                fields=["render_dependencies"],
+                name="routeros_render_deps_gin",
+                opclasses=["jsonb_path_ops"],
+            ),
+        ]
 
     def __str__(self):
         if self.device_id:
@@ -69,36 +126,207 @@ class ConfiguredDevice(ChangeLoggedModel):
         else:
             return "New configured device"
 
-    def generate_config(self) -> RouterOSConfig:
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_render_inputs = instance._render_inputs()
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_render_inputs = self._render_inputs()
+
+    def render_inputs_changed(self) -> bool:
+        """Have the fields which change what is rendered been changed since
+        the device was loaded or last saved?"""
+        loaded = getattr(self, "_loaded_render_inputs", None)
+        return loaded is None or loaded != self._render_inputs()
+
+    def _render_inputs(self) -> tuple:
+        # Read from __dict__ so that deferred fields are not loaded
+        return tuple(self.__dict__.get(field) for field in self.RENDER_FIELDS)
+
+    def generate_config(
+        self,
+        render_data: DeviceRenderData = None,
+        use_cache=False,
+        context: dict = None,
+        recorder: RenderRecorder = None,
+        profiler: RenderProfiler = None,
+    ) -> RouterOSConfig:
+        """Render and parse the config for this device
+
+        If use_cache is set, a previously generated config is returned if none
+        of its inputs have changed (see DeviceRenderData.fingerprint()). Only
+        use this for display purposes, as changes to data which templates query
+        for themselves are not detected.
+
+        A template context may be passed in to avoid building it again, in
+        which case render_data must be the data that context was built from.
+        A recorder and/or profiler may be passed in to record what the render
+        depends upon and where its time is spent, although nothing will be
+        recorded if a cached config is used.
+        """
+        render_data = render_data or DeviceRenderData(self.device)
+        generate = lambda: self._generate_config(
+            render_data, context, recorder, profiler
+        )
+        if not use_cache:
+            return generate()
+
+        return get_or_compute(
+            ["config", self._config_inputs(), render_data.fingerprint()], generate
+        )
+
+    def _generate_config(
+        self,
+        render_data: DeviceRenderData,
+        context: Optional[dict],
+        recorder: Optional[RenderRecorder],
+        profiler: Optional[RenderProfiler],
+    ) -> RouterOSConfig:
         config = render_ros_config(
             self.device,
             template_name=self.configuration_template.slug,
             template_content=self.configuration_template.content,
             extra_config=self.extra_configuration,
+            render_data=render_data,
+            context=context,
+            recorder=recorder,
+            profiler=profiler,
         )
-        return RouterOSConfig.parse(config)
+        with profile_stage(profiler, "parse config"):
+            return RouterOSConfig.parse(config)
+
+    def _config_inputs(self) -> list:
+        return [
+            self.configuration_template.slug,
+            self.configuration_template.content,
+            self.extra_configuration,
+            # Covers any templates included by this one
+            get_templates_version(),
+        ]
 
     def parse_last_config_fetched(self) -> Optional[RouterOSConfig]:
-        if self.last_config_fetched:
-            return RouterOSConfig.parse(self.last_config_fetched)
-        else:
-            return None
+        return self._parse_fetched("last_config_fetched", "last_config_parsed")
 
     def parse_last_verbose_config_fetched(self) -> Optional[RouterOSConfig]:
-        if self.last_verbose_config_fetched:
-            return RouterOSConfig.parse(self.last_verbose_config_fetched)
-        else:
+        return self._parse_fetched(
+            "last_verbose_config_fetched", "last_verbose_config_parsed"
+        )
+
+    def _parse_fetched(self, text_field: str, parsed_field: str):
+        """Get a fetched config in parsed form
+
+        The stored parsed form is used if it is up to date, otherwise the
+        text is parsed and the parsed form is stored for next time.
+        """
+        text = getattr(self, text_field)
+        if not text:
             return None
 
-    def generate_diff(self) -> Optional[RouterOSConfig]:
-        old = self.parse_last_config_fetched()
-        if not old:
+        config = load_config(getattr(self, parsed_field), text)
+        if config is None:
+            config = RouterOSConfig.parse(text)
+            setattr(self, parsed_field, dump_config(text, config))
+            if self.pk:
+                ConfiguredDevice.objects.filter(pk=self.pk).update(
+                    **{parsed_field: getattr(self, parsed_field)}
+                )
+        return config
+
+    def generate_diff(
+        self,
+        render_data: DeviceRenderData = None,
+        use_cache=False,
+        config: RouterOSConfig = None,
+        old: RouterOSConfig = None,
+        recorder: RenderRecorder = None,
+    ) -> Optional[RouterOSConfig]:
+        """Get the commands needed to bring the device in line with its template
+
+        The generated config and/or the parsed last fetched config may be
+        passed in if they are already available, otherwise they will be
+        generated/parsed as needed. See generate_config() regarding use_cache
+        and recorder.
+        """
+        if not self.last_config_fetched:
             return
-        return self.generate_config().diff(
-            old=self.parse_last_config_fetched(),
-            old_verbose=self.parse_last_verbose_config_fetched(),
+
+        def _generate_diff():
+            new = config or self.generate_config(
+                render_data, use_cache, recorder=recorder
+            )
+            return new.diff(
+                old=old or self.parse_last_config_fetched(),
+                old_verbose=self.parse_last_verbose_config_fetched(),
+            )
+
+        if not use_cache:
+            return _generate_diff()
+
+        render_data = render_data or DeviceRenderData(self.device)
+        return get_or_compute(
+            [
+                "diff",
+                self._config_inputs(),
+                render_data.fingerprint(),
+                self.last_config_fetched,
+                self.last_verbose_config_fetched,
+            ],
+            _generate_diff,
         )
 
+    def check_drift(self, render_data: DeviceRenderData = None):
+        """Update the summary of how the device differs from its template
+
+        in_sync is left as None if the device's config has never been
+        fetched, or if the template could not be rendered. In the latter
+        case the error is recorded and then raised.
+
+        Also records what the render depended upon (see RenderRecorder), and
+        so clears stale_since unless something has changed since the render
+        began.
+        """
+        render_data = render_data or DeviceRenderData(self.device)
+        recorder = RenderRecorder(render_data)
+        started = now()
+        drift = dict(
+            in_sync=None,
+            drift_commands=None,
+            drift_sections=[],
+            drift_hash="",
+            drift_error="",
+            drift_checked_at=started,
+        )
+        try:
+            diff = self.generate_diff(render_data, recorder=recorder)
+        except Exception as e:
+            drift["drift_error"] = f"{e.__class__.__name__}: {e}"
+            raise
+        else:
+            if diff is not None:
+                sections = [s for s in diff.sections if s.expressions]
+                drift.update(
+                    in_sync=not sections,
+                    drift_commands=sum(len(s.expressions) for s in sections),
+                    drift_sections=[s.path for s in sections],
+                    drift_hash=hashlib.sha256(str(diff).encode("utf8")).hexdigest(),
+                )
+        finally:
+            drift["render_dependencies"] = recorder.as_dict()
+            for field, value in drift.items():
+                setattr(self, field, value)
+            # Update directly, as this is not a change to the object
+            # which should appear in the changelog
+            if self.pk:
+                ConfiguredDevice.objects.filter(pk=self.pk).update(**drift)
+                ConfiguredDevice.objects.filter(
+                    pk=self.pk, stale_since__lte=started
+                ).update(stale_since=None)
+            if self.stale_since and self.stale_since <= started:
+                self.stale_since = None
+
     @cached_property
     def problems(self):
         """There are a bunch of things that may cause issues. Let's check for them
@@ -126,12 +354,11 @@ class ConfiguredDevice(ChangeLoggedModel):
 
         # Validate the configured driver
         if not self.device.platform:
-            problems.append("No platform configured for device")
-            return
+            return problems
 
         if not self.device.platform.napalm_driver:
             problems.append("Device's platform has no napalm driver set")
-            return
+            return problems
 
         try:
             napalm.get_network_driver(self.device.platform.napalm_driver)
@@ -142,27 +369,63 @@ class ConfiguredDevice(ChangeLoggedModel):
 
         return problems
 
-    def fetch_config(self):
-        driver = get_napalm_driver(self.device)
+    def fetch_config(self, driver=None, verbose=True):
+        """Fetch both the terse and verbose config from the device
+
+        Both exports are made using the one driver. Pass in a driver from
+        napalm_session() to reuse it. The driver only holds a single session
+        open if the napalm_open_sessions setting is enabled. Otherwise each
+        export connects separately, as before.
+
+        If verbose is False then only the terse config is fetched, and the
+        stored verbose config is kept.
+        """
+        if driver is None:
+            with napalm_session(self.device) as driver:
+                return self.fetch_config(driver, verbose)
+
         self.last_config_fetched = driver.get_config(
             retrieve="running", full=False, sanitized=False
         )["running"]
-        self.last_verbose_config_fetched = driver.get_config(
-            retrieve="running", full=True, sanitized=False
-        )["running"]
+        fields = [("last_config_fetched", "last_config_parsed")]
+        if verbose:
+            self.last_verbose_config_fetched = driver.get_config(
+                retrieve="running", full=True, sanitized=False
+            )["running"]
+            fields.append(("last_verbose_config_fetched", "last_verbose_config_parsed"))
         self.last_config_fetched_at = now()
-        self.save()
+        # Parse now, rather than each time the configs are used
+        for text_field, parsed_field in fields:
+            text = getattr(self, text_field)
+            setattr(self, parsed_field, dump_config(text, RouterOSConfig.parse(text)))
+        # Only the fetched fields, so that values written by others in the
+        # meantime (such as by check_drift()) are not overwritten
+        self.save(
+            update_fields=[field for pair in fields for field in pair]
+            + ["last_config_fetched_at", "last_config_pushed_at"]
+        )
+
+        try:
+            self.check_drift()
+        except Exception:
+            # Recorded by check_drift(), and the fetch itself succeeded
+            pass
 
     def push_config(self):
-        driver = get_napalm_driver(self.device)
-        driver.load_replace_candidate(
-            config=self.generate_config(),
-            current_config=self.parse_last_config_fetched(),
-            current_config_verbose=self.parse_last_verbose_config_fetched(),
-        )
-        self.last_config_pushed_at = now()
-        self.fetch_config()
-        self.save()
+        with napalm_session(self.device) as driver:
+            driver.load_replace_candidate(
+                config=self.generate_config(),
+                current_config=self.parse_last_config_fetched(),
+                current_config_verbose=self.parse_last_verbose_config_fetched(),
+            )
+            self.last_config_pushed_at = now()
+            # Refresh our copy of the device's config using the same driver.
+            # Only the terse export is needed to see what the push changed.
+            # The verbose export only supplies the defaults of properties
+            # which the terse config leaves unset, is much the slower of the
+            # two, and is refreshed by the next fetch. This also saves
+            # last_config_pushed_at
+            self.fetch_config(driver, verbose=False)
 
 
 class ConfigurationTemplate(ChangeLoggedModel):
@@ -185,3 +448,87 @@ class ConfigurationTemplate(ChangeLoggedModel):
 
     def __str__(self):
         return self.name
+
+
+class ConfigJob(models.Model):
+    """A background job which fetches config, pushes config, or checks drift
+    for a set of devices"""
+
+    KIND_FETCH = "fetch"
+    KIND_PUSH = "push"
+    KIND_DRIFT = "drift"
+    KIND_CHOICES = (
+        (KIND_FETCH, "Fetch config"),
+        (KIND_PUSH, "Push config"),
+        (KIND_DRIFT, "Check drift"),
+    )
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETED = "completed"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_COMPLETED, "Completed"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+    user = models.ForeignKey(
+        to=settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        blank=True,
+        null=True,
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(default=None, null=True, blank=True)
+    completed_at = models.DateTimeField(default=None, null=True, blank=True)
+    error = models.TextField(default="", blank=True)
+
+    objects = RestrictedQuerySet.as_manager()
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.pk}"
+
+    def get_absolute_url(self):
+        return reverse("plugins:netbox_routeros:configjob", args=[self.pk])
+
+    @property
+    def finished(self):
+        return self.status in (self.STATUS_COMPLETED, self.STATUS_FAILED)
+
+
+class ConfigJobDevice(models.Model):
+    """The progress of a single device within a ConfigJob"""
+
+    job = models.ForeignKey(
+        to="netbox_routeros.ConfigJob",
+        on_delete=models.CASCADE,
+        related_name="devices",
+    )
+    configured_device = models.ForeignKey(
+        to="netbox_routeros.ConfiguredDevice",
+        on_delete=models.CASCADE,
+        related_name="jobs",
+    )
+    # One of the DeviceResult statuses, or pending
+    status = models.CharField(max_length=20, default=ConfigJob.STATUS_PENDING)
+    error = models.TextField(default="", blank=True)
+    duration = models.FloatField(
+        default=None, null=True, blank=True, help_text="Seconds"
+    )
+    completed_at = models.DateTimeField(default=None, null=True, blank=True)
+
+    class Meta:
+        ordering = ["job", "configured_device__device__name"]
+
+    def __str__(self):
+        return f"{self.job}: {self.configured_device}"
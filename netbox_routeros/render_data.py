@@ -0,0 +1,400 @@
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Iterable, List
+
+import netaddr
+
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import F, Func, QuerySet, prefetch_related_objects
+from django.db.models.functions import Cast
+
+from dcim.models import Device
+from extras.models import ConfigContext
+from ipam.fields import IPAddressField
+from ipam.models import IPAddress, VLAN, Prefix
+from netbox_routeros.indexes import (
+    InterfaceIndex,
+    PrefixIndex,
+    VlanAddressIndex,
+    get_prefix_index,
+    load_interface_indexes,
+)
+from netbox_routeros.utilities.cache import fingerprint
+from utilities.utils import deepmerge
+
+
+class Any(Func):
+    function = "ANY"
+
+
+class DeviceRenderData:
+    """The IPAM data made available to a device's template
+
+    Each dataset is fetched from the database at most once, no matter how many
+    times the template uses it. The IPv4 & IPv6 variants are filtered in memory
+    from the full dataset, so they do not cause further queries.
+
+    The datasets are exposed as querysets so templates can still chain further
+    filters onto them (although doing so will of course query the database).
+    """
+
+    DATASETS = ("ip_addresses", "prefixes", "vlans")
+
+    def __init__(
+        self,
+        device: Device,
+        rows: Dict[str, list] = None,
+        config_context=None,
+        interface_index: InterfaceIndex = None,
+    ):
+        self.device = device
+        # Dataset name -> loaded rows. Rows may be provided up front
+        # (see load_render_data()), otherwise they are queried as needed
+        self._rows: Dict[str, list] = dict(rows or {})
+        self._querysets: Dict[str, QuerySet] = {}
+        self._config_context = config_context
+        self._fingerprint = None
+        self._interface_index = interface_index
+        self._vlan_address_index = None
+        self._prefix_index = None
+        self._prefixes_by_pk: Dict[int, Prefix] = {}
+
+    def __getstate__(self):
+        # Querysets cannot be pickled along with the functions which back
+        # them, so load all the data and pickle that instead. The querysets
+        # will be recreated as needed once unpickled.
+        self.load_all()
+        state = self.__dict__.copy()
+        state["_querysets"] = {}
+        # The prefix index is shared by the process, and may be large
+        state["_prefix_index"] = None
+        return state
+
+    @property
+    def config_context(self) -> dict:
+        if self._config_context is None:
+            self._config_context = self.device.get_config_context()
+        return self._config_context
+
+    @property
+    def ip_addresses(self) -> QuerySet:
+        return self._queryset("ip_addresses")
+
+    @property
+    def ip_addresses_v4(self) -> QuerySet:
+        return self._queryset("ip_addresses", family=4)
+
+    @property
+    def ip_addresses_v6(self) -> QuerySet:
+        return self._queryset("ip_addresses", family=6)
+
+    @property
+    def prefixes(self) -> QuerySet:
+        return self._queryset("prefixes")
+
+    @property
+    def prefixes_v4(self) -> QuerySet:
+        return self._queryset("prefixes", family=4)
+
+    @property
+    def prefixes_v6(self) -> QuerySet:
+        return self._queryset("prefixes", family=6)
+
+    @property
+    def vlans(self) -> QuerySet:
+        return self._queryset("vlans")
+
+    @property
+    def interface_index(self) -> InterfaceIndex:
+        """The device's interfaces, addresses & VLANs, as used by get_interface()"""
+        if self._interface_index is None:
+            self._interface_index = load_interface_indexes(
+                [self.device], {self.device.pk: self.rows("ip_addresses")}
+            )[self.device.pk]
+        return self._interface_index
+
+    @property
+    def vlan_address_index(self) -> VlanAddressIndex:
+        """The device's address on each VLAN, as used by get_address()
+
+        Built on first use with a single query, which finds the prefixes of
+        any VLAN containing one of the device's addresses.
+        """
+        if self._vlan_address_index is None:
+            ip_addresses = self.rows("ip_addresses")
+            vlan_prefixes = []
+            if ip_addresses:
+                vlan_prefixes = Prefix.objects.filter(
+                    vlan__isnull=False,
+                    prefix__net_contains_or_equals=self._any_address(),
+                ).values_list("vlan_id", "prefix")
+            self._vlan_address_index = VlanAddressIndex(ip_addresses, vlan_prefixes)
+        return self._vlan_address_index
+
+    @property
+    def prefix_index(self) -> PrefixIndex:
+        """The index of all prefixes, as used by get_prefix()
+
+        Checked for changes once per render data, rather than per lookup.
+        """
+        if self._prefix_index is None:
+            self._prefix_index = get_prefix_index()
+        return self._prefix_index
+
+    def get_prefixes_by_pk(self, pks: Iterable[int]) -> Dict[int, Prefix]:
+        """Get prefixes by pk, avoiding a query where they are already loaded
+
+        This will be the case for the prefixes which cover the device's
+        addresses.
+        """
+        if not self._prefixes_by_pk:
+            self._prefixes_by_pk = {p.pk: p for p in self.rows("prefixes")}
+        missing = {pk for pk in pks if pk not in self._prefixes_by_pk}
+        if missing:
+            self._prefixes_by_pk.update(Prefix.objects.in_bulk(missing))
+        return {
+            pk: self._prefixes_by_pk[pk] for pk in pks if pk in self._prefixes_by_pk
+        }
+
+    def rows(self, name: str) -> list:
+        """Get the loaded rows for a dataset, loading them if needed"""
+        if name not in self._rows:
+            self._rows[name] = list(self._base_queryset(name))
+        return self._rows[name]
+
+    def load_all(self):
+        """Load all datasets now, rather than when they are first used"""
+        for name in self.DATASETS:
+            self.rows(name)
+        self.config_context
+
+    def fingerprint(self) -> str:
+        """Get a hash which changes whenever the data given to the template does
+
+        Covers the device itself, its config context, its interfaces (as used
+        by get_interface()), and the addresses, prefixes & VLANs in the
+        template context (including their modification times). Other data
+        which a template queries for itself, such as via template functions,
+        is not covered.
+        """
+        if self._fingerprint:
+            return self._fingerprint
+
+        self.load_all()
+        data = dict(
+            device=[self.device.pk, self.device.last_updated],
+            config_context=self.config_context,
+            interfaces=[
+                [interface.pk, interface.last_updated]
+                for interface in self.interface_index.interfaces
+            ],
+            **{
+                name: [[obj.pk, obj.last_updated] for obj in self.rows(name)]
+                for name in self.DATASETS
+            },
+        )
+        self._fingerprint = fingerprint(data)
+        return self._fingerprint
+
+    def host_addresses(self) -> List[str]:
+        """Get the host part of each of the device's addresses"""
+        return [str(ip.address.ip) for ip in self.rows("ip_addresses")]
+
+    def _base_queryset(self, name: str) -> QuerySet:
+        return {
+            "ip_addresses": self._ip_addresses_queryset,
+            "prefixes": self._prefixes_queryset,
+            "vlans": self._vlans_queryset,
+        }[name]()
+
+    def _ip_addresses_queryset(self) -> QuerySet:
+        return IPAddress.objects.filter(interface__device=self.device)
+
+    def _prefixes_queryset(self) -> QuerySet:
+        return Prefix.objects.filter(
+            prefix__net_contains=self._any_address()
+        ).distinct()
+
+    def _vlans_queryset(self) -> QuerySet:
+        return VLAN.objects.filter(
+            prefixes__prefix__net_contains=self._any_address()
+        ).distinct()
+
+    def _any_address(self):
+        """Utility for querying against any device address"""
+        addresses = Cast(
+            self.host_addresses(), output_field=ArrayField(IPAddressField())
+        )
+        return Any(addresses)
+
+    def _queryset(self, name: str, family: int = None) -> QuerySet:
+        key = f"{name}_v{family}" if family else name
+        if key in self._querysets:
+            return self._querysets[key]
+
+        queryset = self._base_queryset(name)
+        if family:
+            field = "address" if name == "ip_addresses" else "prefix"
+            queryset = queryset.filter(**{f"{field}__family": family})
+            load = lambda: [obj for obj in self.rows(name) if obj.family == family]
+        else:
+            load = lambda: self.rows(name)
+
+        self._querysets[key] = backed_queryset(queryset, load)
+        return self._querysets[key]
+
+
+def load_render_data(devices: Iterable[Device]) -> Dict[int, DeviceRenderData]:
+    """Load the render data for many devices using a fixed number of queries
+
+    Returns a DeviceRenderData for each device, keyed by device pk. The data
+    is identical to that which each device would have loaded for itself.
+    """
+    devices = list(devices)
+
+    # All the devices' addresses, grouped by device
+    ip_addresses = defaultdict(list)
+    for ip_address in IPAddress.objects.filter(interface__device__in=devices).annotate(
+        _device_id=F("interface__device")
+    ):
+        ip_addresses[ip_address._device_id].append(ip_address)
+
+    # Every prefix which covers any of the addresses. Work out which
+    # device(s) each prefix is relevant to in memory
+    hosts = [str(ip.address.ip) for ips in ip_addresses.values() for ip in ips]
+    all_prefixes = list(
+        Prefix.objects.filter(
+            prefix__net_contains=Any(
+                Cast(hosts, output_field=ArrayField(IPAddressField()))
+            )
+        ).distinct()
+    )
+    # The same network may appear more than once (e.g. in different VRFs)
+    networks = defaultdict(list)
+    for i, p in enumerate(all_prefixes):
+        networks[(p.prefix.version, p.prefix.prefixlen, p.prefix.first)].append(i)
+    prefix_indexes = defaultdict(set)
+    for device_id, device_ip_addresses in ip_addresses.items():
+        for ip_address in device_ip_addresses:
+            prefix_indexes[device_id].update(
+                _covering_prefix_indexes(networks, ip_address.address)
+            )
+
+    all_vlans = list(
+        VLAN.objects.filter(pk__in={p.vlan_id for p in all_prefixes if p.vlan_id})
+    )
+
+    config_contexts = load_config_contexts(devices)
+    interface_indexes = load_interface_indexes(devices, ip_addresses)
+
+    render_data = {}
+    for device in devices:
+        # Maintain the ordering returned by the database
+        prefixes = [all_prefixes[i] for i in sorted(prefix_indexes[device.pk])]
+        vlan_ids = {p.vlan_id for p in prefixes}
+        render_data[device.pk] = DeviceRenderData(
+            device,
+            rows=dict(
+                ip_addresses=ip_addresses[device.pk],
+                prefixes=prefixes,
+                vlans=[vlan for vlan in all_vlans if vlan.pk in vlan_ids],
+            ),
+            config_context=config_contexts[device.pk],
+            interface_index=interface_indexes[device.pk],
+        )
+    return render_data
+
+
+def load_config_contexts(devices: List[Device]) -> Dict[int, dict]:
+    """Get the config context of many devices, keyed by device pk
+
+    The same as calling get_config_context() on each device, except that the
+    config contexts are only queried & merged once for each distinct scope
+    (see config_context_scope()). Devices without local context data share
+    the resulting dict, so it must not be modified.
+    """
+    prefetch_related_objects(devices, "site", "cluster", "tenant", "tags")
+
+    scoped: Dict[tuple, dict] = {}
+    config_contexts = {}
+    for device in devices:
+        scope = config_context_scope(device)
+        if scope not in scoped:
+            data = OrderedDict()
+            for config_context in ConfigContext.objects.get_for_object(device):
+                data = deepmerge(data, config_context.data)
+            scoped[scope] = data
+
+        data = scoped[scope]
+        if device.local_context_data:
+            data = deepmerge(data, device.local_context_data)
+        config_contexts[device.pk] = data
+    return config_contexts
+
+
+def config_context_scope(device: Device) -> tuple:
+    """Get everything which determines the config contexts applying to a device
+
+    Devices with the same scope have the same config contexts, although their
+    local context data may differ.
+    """
+    return (
+        device.site_id,
+        device.site.region_id if device.site else None,
+        device.device_type_id,
+        device.device_role_id,
+        device.platform_id,
+        device.cluster_id,
+        device.cluster.group_id if device.cluster else None,
+        device.tenant_id,
+        device.tenant.group_id if device.tenant else None,
+        tuple(sorted(tag.pk for tag in device.tags.all())),
+    )
+
+
+def _covering_prefix_indexes(
+    networks: Dict[tuple, List[int]], address: netaddr.IPNetwork
+):
+    """Find the networks which strictly contain the address's host IP"""
+    ip = address.ip
+    width = 32 if ip.version == 4 else 128
+    for prefixlen in range(0, width):
+        host_bits = width - prefixlen
+        first = ip.value >> host_bits << host_bits
+        yield from networks.get((ip.version, prefixlen, first), ())
+
+
+def backed_queryset(queryset: QuerySet, load: Callable[[], list]) -> QuerySet:
+    """Have a queryset take its results from load() rather than the database
+
+    load() is only called if the results are actually needed. Any queryset
+    derived from this one (via filter(), order_by(), etc) is a normal queryset
+    and will query the database as usual.
+    """
+
+    def _fetch_all():
+        if queryset._result_cache is None:
+            queryset._result_cache = list(load())
+        # Let Django handle anything else, such as prefetch_related()
+        type(queryset)._fetch_all(queryset)
+
+    def count():
+        _fetch_all()
+        return len(queryset._result_cache)
+
+    def exists():
+        _fetch_all()
+        return bool(queryset._result_cache)
+
+    queryset._fetch_all = _fetch_all
+    queryset.count = count
+    queryset.exists = exists
+    queryset._backed = True
+    return queryset
+
+
+def is_loaded(queryset: QuerySet) -> bool:
+    """Will iterating the queryset avoid querying the database?
+
+    True if it has already been evaluated, or is a backed_queryset()
+    """
+    return queryset._result_cache is not None or getattr(queryset, "_backed", False)
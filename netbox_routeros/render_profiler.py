@@ -0,0 +1,130 @@
+import functools
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from django.db import connection
+
+
+@dataclass
+class ProfiledQuery:
+    sql: str
+    # Seconds
+    duration: float
+
+
+@dataclass
+class ProfiledFunction:
+    calls: int = 0
+    # Seconds, including any queries made by the function
+    duration: float = 0.0
+
+
+class RenderProfiler:
+    """Records where the time goes when rendering a config
+
+    Records:
+
+    * stages: The time spent in each stage of the render, such as building
+      the context, rendering the template, and parsing the result.
+    * functions: The calls to, and time spent in, each template function.
+    * queries: Each SQL query issued during the render.
+
+    Pass a profiler to render_ros_config() or ConfiguredDevice.generate_config()
+    to use it. Only queries made by the current thread are recorded.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.functions: Dict[str, ProfiledFunction] = defaultdict(ProfiledFunction)
+        self.queries: List[ProfiledQuery] = []
+        self._capturing = False
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of the render, recording any queries it makes"""
+        started = time.perf_counter()
+        try:
+            with self.capture_queries():
+                yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    @contextmanager
+    def capture_queries(self):
+        if self._capturing:
+            # Already capturing for an enclosing stage
+            yield
+            return
+
+        self._capturing = True
+        try:
+            with connection.execute_wrapper(self._record_query):
+                yield
+        finally:
+            self._capturing = False
+
+    def wrap_function(self, name: str, function: Callable) -> Callable:
+        """Wrap a template function so the time spent in it is recorded"""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiled = self.functions[name]
+                profiled.calls += 1
+                profiled.duration += time.perf_counter() - started
+
+        return wrapper
+
+    @property
+    def total_duration(self) -> float:
+        return sum(self.stages.values())
+
+    @property
+    def query_duration(self) -> float:
+        return sum(query.duration for query in self.queries)
+
+    def duplicate_queries(self) -> List[tuple]:
+        """Get each query which was issued more than once, and how many times
+
+        Most frequent first. Queries are compared including their parameters.
+        """
+        counts = Counter(query.sql for query in self.queries)
+        return [(sql, count) for sql, count in counts.most_common() if count > 1]
+
+    def as_dict(self) -> dict:
+        """Summarise the profile, for display"""
+        return dict(
+            total_duration=self.total_duration,
+            stages=sorted(self.stages.items(), key=lambda item: -item[1]),
+            functions=sorted(
+                self.functions.items(), key=lambda item: -item[1].duration
+            ),
+            query_count=len(self.queries),
+            query_duration=self.query_duration,
+            duplicate_queries=self.duplicate_queries(),
+            slowest_queries=sorted(self.queries, key=lambda q: -q.duration)[:10],
+        )
+
+    def _record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            try:
+                sql = context["cursor"].mogrify(sql, params).decode()
+            except Exception:
+                sql = f"{sql} {params!r}" if params else sql
+            self.queries.append(
+                ProfiledQuery(sql=sql, duration=time.perf_counter() - started)
+            )
+
+
+def profile_stage(profiler: Optional[RenderProfiler], name: str):
+    """Time a render stage if profiling, otherwise do nothing"""
+    return profiler.stage(name) if profiler else nullcontext()
@@ -0,0 +1,136 @@
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Set
+
+from django.db.models import Model, QuerySet
+from jinja2.runtime import Context
+
+from netbox_routeros.render_data import DeviceRenderData
+
+# The key under which the recorder is made available to RecordingContext
+RECORDER_KEY = "_routeros_recorder"
+
+# The recorder for the render in progress, if any. Used where the Jinja
+# context is not available, such as when accessing attributes
+_active_recorder: ContextVar[Optional["RenderRecorder"]] = ContextVar(
+    "routeros_recorder", default=None
+)
+
+# Context variables which provide one of the render data's datasets
+DATASET_VARIABLES = {
+    "ip_addresses": "ip_addresses",
+    "ip_addresses_v4": "ip_addresses",
+    "ip_addresses_v6": "ip_addresses",
+    "prefixes": "prefixes",
+    "prefixes_v4": "prefixes",
+    "prefixes_v6": "prefixes",
+    "vlans": "vlans",
+}
+
+
+class RenderRecorder:
+    """Records what a render depended upon
+
+    Specifically:
+
+    * objects: The model instances used, by model label. This includes rows
+      from any of the render data's datasets used by the template, the
+      interfaces of any addresses used, and anything returned by template
+      functions.
+    * models: The models the template accessed by name (i.e. to make its own
+      queries), or which template functions returned querysets of. Any
+      change to these models may affect the render.
+    * functions: The number of times each template function was called.
+
+    Pass a recorder to render_ros_config() to use it.
+    """
+
+    def __init__(self, render_data: DeviceRenderData = None):
+        self.render_data = render_data
+        self.objects: Dict[str, Set[int]] = defaultdict(set)
+        self.models: Set[str] = set()
+        self.functions: Dict[str, int] = defaultdict(int)
+        self._datasets_recorded: Set[str] = set()
+
+    def record_variable(self, name: str, value):
+        """Record that the template used a variable from its context"""
+        if name in DATASET_VARIABLES and self.render_data:
+            self.record_dataset(DATASET_VARIABLES[name])
+        elif isinstance(value, type) and issubclass(value, Model):
+            self.models.add(value._meta.label_lower)
+        else:
+            self.record_value(value)
+
+    def record_dataset(self, name: str):
+        if name in self._datasets_recorded:
+            return
+        self._datasets_recorded.add(name)
+        for obj in self.render_data.rows(name):
+            self.record_value(obj)
+            if name == "ip_addresses" and obj.assigned_object_id:
+                self.objects["dcim.interface"].add(obj.assigned_object_id)
+
+    def record_value(self, value):
+        """Record a model instance, or any contained within a list or similar"""
+        if isinstance(value, Model):
+            if value.pk is not None:
+                self.objects[value._meta.label_lower].add(value.pk)
+        elif isinstance(value, QuerySet):
+            # Do not evaluate the queryset, as the template may not
+            self.models.add(value.model._meta.label_lower)
+        elif isinstance(value, (list, tuple, set)):
+            for item in value:
+                self.record_value(item)
+
+    def wrap_function(self, name: str, function: Callable) -> Callable:
+        """Wrap a template function so that its calls & results are recorded"""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self.functions[name] += 1
+            result = function(*args, **kwargs)
+            self.record_value(result)
+            return result
+
+        return wrapper
+
+    def as_dict(self) -> dict:
+        """Get the recorded dependencies in a form suitable for storing as JSON"""
+        return dict(
+            objects={label: sorted(pks) for label, pks in sorted(self.objects.items())},
+            models=sorted(self.models),
+            functions=dict(sorted(self.functions.items())),
+        )
+
+
+class RecordingContext(Context):
+    """A Jinja context which tells the render's recorder, if any, about
+    each variable the template uses"""
+
+    def resolve_or_missing(self, key):
+        value = super().resolve_or_missing(key)
+        recorder = self.parent.get(RECORDER_KEY)
+        if recorder is not None:
+            recorder.record_variable(key, value)
+        return value
+
+
+@contextmanager
+def recording(recorder: Optional[RenderRecorder]):
+    """Make the recorder available to record_attribute() during a render"""
+    token = _active_recorder.set(recorder)
+    try:
+        yield
+    finally:
+        _active_recorder.reset(token)
+
+
+def record_attribute(value):
+    """Record a model instance reached via an attribute or item, such as the
+    VLAN in prefix.vlan"""
+    if isinstance(value, Model):
+        recorder = _active_recorder.get()
+        if recorder is not None:
+            recorder.record_value(value)
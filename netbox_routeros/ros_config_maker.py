@@ -1,59 +1,91 @@
-from functools import partial
+import hashlib
+import multiprocessing
+import os
+import threading
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache, partial
 from ipaddress import (
-    collapse_addresses,
     IPv4Interface,
     IPv6Address,
     IPv6Network,
     IPv4Network,
-    ip_network,
-    ip_interface,
 )
-from typing import Union, List, Optional
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Mapping,
+    Union,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
 
 import django.apps
+from django import db
 from django.contrib.postgres.fields import ArrayField
-from django.db.models import Func
+from django.db.models import Count, Max, Model
 from django.db.models.functions import Cast
 from django.utils.module_loading import import_string
-from jinja2 import Environment, BaseLoader, TemplateNotFound
+from jinja2 import Environment, BaseLoader, Template, TemplateNotFound
+from jinja2.runtime import Context, missing
 import netaddr
+from routeros_diff import RouterOSConfig
 
 from dcim.models import Device, Interface
 from ipam.fields import IPAddressField
 from ipam.models import IPAddress, VLAN, Q, Prefix
-from utilities.utils import deepmerge
+from netbox_routeros.indexes import ANY_VRF, get_prefix_index
+from netbox_routeros.render_data import Any, DeviceRenderData, load_render_data
+from netbox_routeros.render_profiler import RenderProfiler, profile_stage
+from netbox_routeros.render_recorder import (
+    RECORDER_KEY,
+    RecordingContext,
+    RenderRecorder,
+    record_attribute,
+    recording,
+)
+from netbox_routeros.utilities import prefixes as prefixes_utils
 
 
-class Any(Func):
-    function = "ANY"
+# Compiled templates are cached process-wide, keyed by template name
+# and a hash of the template's content
+COMPILED_TEMPLATE_CACHE_SIZE = 500
+_compiled_templates: "OrderedDict[Tuple[str, str], Template]" = OrderedDict()
+_compiled_templates_lock = threading.Lock()
+_environment: Optional[Environment] = None
+# The last known modification time of each ConfigurationTemplate, by slug.
+# Templates loaded via RosTemplateLoader are considered out of date once
+# their modification time differs. See refresh_template_versions()
+_template_versions: Dict[str, datetime] = {}
 
 
 class RosTemplateLoader(BaseLoader):
-    def __init__(self, overrides: dict = None):
-        self.overrides = overrides or {}
-
     def get_source(self, environment, template):
         from netbox_routeros.models import ConfigurationTemplate
 
         # TODO: Does not support tenants
-        if template in self.overrides:
-            return (
-                self.overrides[template],
-                template,
-                lambda: content == self.overrides[template],
-            )
-
         try:
-            content = ConfigurationTemplate.objects.get(slug=template).content
+            configuration_template = ConfigurationTemplate.objects.only(
+                "content", "last_updated"
+            ).get(slug=template)
         except ConfigurationTemplate.DoesNotExist:
             raise TemplateNotFound(template)
-        else:
-            return (
-                content,
-                template,
-                lambda: content
-                == ConfigurationTemplate.objects.get(slug=template).content,
-            )
+
+        # Rather than query the database each time the template is used,
+        # rely on the versions being refreshed once per render
+        last_updated = configuration_template.last_updated
+        _template_versions[template] = last_updated
+        return (
+            configuration_template.content,
+            template,
+            lambda: _template_versions.get(template) == last_updated,
+        )
 
     def list_templates(self):
         from netbox_routeros.models import ConfigurationTemplate
@@ -61,94 +93,372 @@ class RosTemplateLoader(BaseLoader):
         return ConfigurationTemplate.objects.all().values_list("slug", flat=True)
 
 
+def get_templates_version() -> list:
+    """Identifies the current state of all ConfigurationTemplates
+
+    Changes whenever any template is created, changed or deleted. Used to key
+    cached renders, as a template may include any other template. Costs a
+    single query.
+    """
+    from netbox_routeros.models import ConfigurationTemplate
+
+    return list(
+        ConfigurationTemplate.objects.aggregate(
+            count=Count("pk"), last_updated=Max("last_updated")
+        ).values()
+    )
+
+
+def get_template_source(name: str) -> str:
+    """Get the source of a template, as it would be loaded by name"""
+    source, _, _ = RosTemplateLoader().get_source(get_environment(), name)
+    return source
+
+
+class ModelRegistry(Mapping):
+    """Every model, by name, so templates can make their own queries
+
+    Templates rarely use more than a few models, so they are looked up by
+    name only as the template uses them, rather than every model being
+    added to every template's context.
+    """
+
+    def __getitem__(self, name: str) -> Type[Model]:
+        return _get_models_by_name()[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(_get_models_by_name())
+
+    def __len__(self) -> int:
+        return len(_get_models_by_name())
+
+
+@lru_cache(maxsize=None)
+def _get_models_by_name() -> Dict[str, Type[Model]]:
+    return {m._meta.object_name: m for m in django.apps.apps.get_models()}
+
+
+template_models = ModelRegistry()
+
+
+class ModelContext(Context):
+    """A Jinja context which falls back to the model registry for any
+    variable not otherwise defined"""
+
+    def resolve_or_missing(self, key):
+        value = super().resolve_or_missing(key)
+        if value is missing:
+            value = template_models.get(key, missing)
+        return value
+
+
+class RosContext(RecordingContext, ModelContext):
+    pass
+
+
+class RosEnvironment(Environment):
+    # Allows renders to be recorded (see render_recorder), and provides
+    # the models to templates
+    context_class = RosContext
+
+    def getattr(self, obj, attribute):
+        value = super().getattr(obj, attribute)
+        record_attribute(value)
+        return value
+
+    def getitem(self, obj, argument):
+        value = super().getitem(obj, argument)
+        record_attribute(value)
+        return value
+
+
+def get_environment() -> Environment:
+    """Get the Jinja environment, which is shared by all renders"""
+    global _environment
+    if _environment is None:
+        _environment = RosEnvironment(
+            loader=RosTemplateLoader(), cache_size=COMPILED_TEMPLATE_CACHE_SIZE
+        )
+    return _environment
+
+
+def get_template(name: str, content: str = None) -> Template:
+    """Get a compiled template
+
+    If content is given then it is used as the template's source, otherwise
+    the template is loaded from the ConfigurationTemplate with the given slug.
+    Either way, each version of a template is only compiled once.
+    """
+    environment = get_environment()
+    if content is None:
+        return environment.get_template(name)
+
+    key = (name, hashlib.sha256(content.encode("utf8")).hexdigest())
+    with _compiled_templates_lock:
+        template = _compiled_templates.get(key)
+        if template:
+            _compiled_templates.move_to_end(key)
+            return template
+
+    code = environment.compile(content, name=name)
+    template = environment.template_class.from_code(
+        environment, code, environment.make_globals(None), None
+    )
+
+    with _compiled_templates_lock:
+        _compiled_templates[key] = template
+        while len(_compiled_templates) > COMPILED_TEMPLATE_CACHE_SIZE:
+            _compiled_templates.popitem(last=False)
+
+    return template
+
+
+def refresh_template_versions():
+    """Check which ConfigurationTemplates have changed since they were loaded
+
+    Templates loaded by slug (such as via an include) which have changed,
+    possibly by another process, will be reloaded when next used. Called
+    once per render. Costs a single query, and only if any templates have
+    been loaded by slug.
+    """
+    from netbox_routeros.models import ConfigurationTemplate
+
+    global _template_versions
+    if not len(get_environment().cache):
+        return
+    _template_versions = dict(
+        ConfigurationTemplate.objects.values_list("slug", "last_updated")
+    )
+
+
+def invalidate_template_cache(name: str = None):
+    """Forget compiled templates following a change to a ConfigurationTemplate
+
+    Only affects the current process, where it avoids waiting for the next
+    render to notice the change (see refresh_template_versions()). Templates
+    rendered from given content are keyed by a hash of that content, so can
+    never be stale.
+    """
+    if name is None:
+        _template_versions.clear()
+    else:
+        _template_versions.pop(name, None)
+    with _compiled_templates_lock:
+        for key in list(_compiled_templates):
+            if name is None or key[0] == name:
+                del _compiled_templates[key]
+
+
 def render_ros_config(
     device: Device,
     template_name: str,
     template_content: str = None,
     extra_config: str = "",
+    render_data: DeviceRenderData = None,
+    context: dict = None,
+    recorder: RenderRecorder = None,
+    profiler: RenderProfiler = None,
 ):
-    overrides = {}
-    if template_name and template_content:
-        overrides[template_name] = template_content
-    if extra_config:
-        overrides["_extra_config"] = extra_config
+    """Render the config for a device
+
+    Pass in a context previously created by make_ros_config_context() in order
+    to render several templates using the one context.
+
+    Pass in a recorder to record what the render depends upon. The recorder
+    should be given the same render data as the render. Pass in a profiler to
+    record where the time is spent.
+    """
+    with profile_stage(profiler, "compile template"):
+        refresh_template_versions()
+        template = get_template(template_name, template_content or None)
+    if context is None:
+        with profile_stage(profiler, "create context"):
+            context = make_ros_config_context(device, render_data=render_data)
+    if recorder is not None:
+        context = _wrap_template_functions(device, context, recorder.wrap_function)
+        context[RECORDER_KEY] = recorder
+    if profiler is not None:
+        context = _wrap_template_functions(device, context, profiler.wrap_function)
+
+    with recording(recorder):
+        with profile_stage(profiler, "render template"):
+            config = template.render(**context)
+
+        if extra_config:
+            with profile_stage(profiler, "compile template"):
+                template = get_template("_extra_config", extra_config)
+            with profile_stage(profiler, "render extra configuration"):
+                rendered_extra_config = template.render(**context)
+            config += f"\n{rendered_extra_config}"
 
-    env = Environment(loader=RosTemplateLoader(overrides),)
-    template = env.get_template(template_name)
-    context = make_ros_config_context(device)
+    return config
 
-    config = template.render(**context)
 
-    if extra_config:
-        template = env.get_template("_extra_config")
-        rendered_extra_config = template.render(**context)
-        config += f"\n{rendered_extra_config}"
+@dataclass
+class RenderResult:
+    device: Device
+    config: Optional[str] = None
+    # Only populated by render_ros_config_parallel()
+    parsed: Optional[RouterOSConfig] = None
+    # The traceback, should rendering fail
+    error: Optional[str] = None
+
+
+def render_ros_config_many(
+    devices: Iterable[Device],
+    template_name: str,
+    template_content: str = None,
+    extra_config: str = "",
+) -> List[RenderResult]:
+    """Render the config for many devices
+
+    The devices' IPAM data is loaded up front using a few set-based queries,
+    rather than a set of queries per device. A failure to render one device
+    does not prevent the others from being rendered.
+    """
+    devices = list(devices)
+    render_data = load_render_data(devices)
+
+    results = []
+    for device in devices:
+        result = RenderResult(device)
+        try:
+            result.config = render_ros_config(
+                device,
+                template_name=template_name,
+                template_content=template_content,
+                extra_config=extra_config,
+                render_data=render_data[device.pk],
+            )
+        except Exception:
+            result.error = traceback.format_exc()
+        results.append(result)
+    return results
+
+
+def render_ros_config_parallel(
+    devices: Iterable[Device],
+    template_name: str,
+    template_content: str = None,
+    extra_config: str = "",
+    processes: int = None,
+) -> List[RenderResult]:
+    """Render and parse the config for many devices using a pool of processes
+
+    Rendering and parsing are CPU-bound, so this allows a large number of
+    devices to make use of all available cores. Each device's data is loaded
+    up front (as per render_ros_config_many()), and is pickled and sent to the
+    worker processes. Note that queries made by template functions will
+    still happen within the workers.
+
+    Setting processes to 1 renders the devices within the current process,
+    as does calling this within a transaction. Worker processes could not see
+    the transaction's data, and the transaction would be lost when the
+    database connection is closed before forking. Worker processes are
+    forked, so this is only supported on Unix-like systems.
+    """
+    devices = list(devices)
+    render_data = load_render_data(devices)
+    jobs = []
+    for device in devices:
+        render_data[device.pk].load_all()
+        jobs.append(
+            (render_data[device.pk], template_name, template_content, extra_config)
+        )
+
+    processes = processes or os.cpu_count() or 1
+    in_transaction = any(c.in_atomic_block for c in db.connections.all())
+    if processes == 1 or len(jobs) <= 1 or in_transaction:
+        return [_render_and_parse(job) for job in jobs]
+
+    # Forked workers must not share the parent's database connections,
+    # so close them now. Each worker will open its own should it need one.
+    db.connections.close_all()
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        chunksize = max(1, len(jobs) // (processes * 4))
+        return pool.map(_render_and_parse, jobs, chunksize=chunksize)
+
+
+def _render_and_parse(job: tuple) -> RenderResult:
+    render_data, template_name, template_content, extra_config = job
+    result = RenderResult(render_data.device)
+    try:
+        result.config = render_ros_config(
+            render_data.device,
+            template_name=template_name,
+            template_content=template_content,
+            extra_config=extra_config,
+            render_data=render_data,
+        )
+        result.parsed = RouterOSConfig.parse(result.config)
+    except Exception:
+        result.error = traceback.format_exc()
+    return result
 
-    return config
 
+def make_ros_config_context(device: Device, render_data: DeviceRenderData = None):
+    """Make the context for rendering a device's template
 
-def make_ros_config_context(device: Device):
-    # Make all models available for custom querying
-    models = {m._meta.object_name: m for m in django.apps.apps.get_models()}
+    Models are not included, as templates look them up on demand. See
+    ModelRegistry.
+    """
+    render_data = render_data or DeviceRenderData(device)
 
     context = dict(
         device=device,
-        vlans=_context_vlans(device),
-        **_context_ip_addresses(device),
-        **_context_prefixes(device),
-        **get_template_functions(device),
-        **models,
+        **_context_vlans(render_data),
+        **_context_ip_addresses(render_data),
+        **_context_prefixes(render_data),
+        **get_template_functions(device, render_data),
     )
-    return dict(deepmerge(context, device.get_config_context()))
+    # None of these values are dicts, so the config context can simply be
+    # layered on top, rather than deep merged. As before, the config context
+    # takes precedence over any of the above
+    context.update(render_data.config_context)
+    return context
 
 
-def _context_ip_addresses(device: Device):
-    # TODO: Test
-    addresses = IPAddress.objects.filter(interface__device=device)
+def _wrap_template_functions(
+    device: Device, context: dict, wrap: Callable[[str, Callable], Callable]
+) -> dict:
+    context = dict(context)
+    for name in get_template_functions(device):
+        if name in context:
+            context[name] = wrap(name, context[name])
+    return context
+
+
+def _context_ip_addresses(render_data: DeviceRenderData):
     return dict(
-        ip_addresses=addresses,
-        ip_addresses_v4=addresses.filter(address__family=4),
-        ip_addresses_v6=addresses.filter(address__family=6),
+        ip_addresses=render_data.ip_addresses,
+        ip_addresses_v4=render_data.ip_addresses_v4,
+        ip_addresses_v6=render_data.ip_addresses_v6,
     )
 
 
-def _context_vlans(device: Device):
-    return VLAN.objects.filter(
-        prefixes__prefix__net_contains=_any_address(device)
-    ).distinct()
+def _context_vlans(render_data: DeviceRenderData):
+    return dict(vlans=render_data.vlans)
 
 
-def _context_prefixes(device: Device):
-    # TODO: Test
-    prefixes = Prefix.objects.filter(
-        prefix__net_contains=_any_address(device)
-    ).distinct()
+def _context_prefixes(render_data: DeviceRenderData):
     return dict(
-        prefixes=prefixes,
-        prefixes_v4=prefixes.filter(prefix__family=4),
-        prefixes_v6=prefixes.filter(prefix__family=6),
+        prefixes=render_data.prefixes,
+        prefixes_v4=render_data.prefixes_v4,
+        prefixes_v6=render_data.prefixes_v6,
     )
 
 
-def _any_address(device: Device):
-    """Utility for querying against any device address"""
-    addresses = [
-        str(ip.ip)
-        for ip in IPAddress.objects.filter(interface__device=device).values_list(
-            "address", flat=True
-        )
-    ]
-    addresses = Cast(addresses, output_field=ArrayField(IPAddressField()))
-    return Any(addresses)
-
-
-def get_template_functions(device):
+def get_template_functions(device, render_data: DeviceRenderData = None):
     return dict(
         get_loopback=get_loopback,
-        get_prefix=get_prefix,
+        get_prefix=partial(get_prefix, render_data=render_data),
+        get_prefixes=partial(get_prefixes, render_data=render_data),
         combine_prefixes=combine_prefixes,
-        get_interface=partial(get_interface, device),
-        get_address=get_address,
+        subtract_prefixes=subtract_prefixes,
+        intersect_prefixes=intersect_prefixes,
+        supernet_prefixes=supernet_prefixes,
+        get_interface=partial(get_interface, device, render_data=render_data),
+        get_address=partial(get_address, render_data=render_data),
         orm_or=orm_or,
         run_python_function=run_python_function,
     )
@@ -167,19 +477,26 @@ def get_loopback(device: Device, number=1, **extra_filters) -> Optional[IPAddres
         return loopback.address.ip
 
 
-def combine_prefixes(prefixes, only_combined=False):
-    in_prefixes = [
-        ip_network(p.prefix if isinstance(p, Prefix) else p) for p in prefixes
-    ]
-    out_prefixes = list(
-        collapse_addresses([p for p in in_prefixes if p.version == 4])
-    ) + list(collapse_addresses([p for p in in_prefixes if p.version == 6]))
+def combine_prefixes(prefixes, only_combined=False) -> List[netaddr.IPNetwork]:
+    """Combine prefixes into the fewest networks covering the same addresses"""
+    return prefixes_utils.combine(prefixes, only_combined=only_combined)
+
+
+def subtract_prefixes(prefixes, excluded) -> List[netaddr.IPNetwork]:
+    """Get the networks covering the prefixes, less those which are excluded"""
+    return prefixes_utils.subtract(prefixes, excluded)
 
-    if only_combined:
-        out_prefixes = [p for p in out_prefixes if p not in in_prefixes]
 
-    # Ensure we use the netaddr IPAddress, rather than the ipaddress.IPvXNetwork
-    return [netaddr.IPNetwork(str(p)) for p in out_prefixes]
+def intersect_prefixes(prefixes, other) -> List[netaddr.IPNetwork]:
+    """Get the networks covering addresses found in both sets of prefixes"""
+    return prefixes_utils.intersect(prefixes, other)
+
+
+def supernet_prefixes(
+    prefixes, v4: int = None, v6: int = None
+) -> List[netaddr.IPNetwork]:
+    """Widen each prefix (e.g. /29s to /24s) for its family, then combine them"""
+    return prefixes_utils.supernets(prefixes, v4=v4, v6=v6)
 
 
 def get_interface(
@@ -197,56 +514,92 @@ def get_interface(
         VLAN,
     ],
     include_vlans=True,
+    render_data: DeviceRenderData = None,
 ):
-    if isinstance(obj, Prefix):
-        obj = obj.prefix
-    elif isinstance(obj, IPAddress):
-        obj = obj.address
+    """Get the device's interface for the given address, network or VLAN
+
+    If include_vlans is set, then a VLAN tagged on the device which has a
+    prefix containing the address/network will be returned in preference.
 
-    if isinstance(obj, (str, netaddr.IPNetwork, netaddr.IPAddress)):
-        obj = ip_interface(str(obj))
+    Lookups are answered from the render data's interface index, so only the
+    first call for a given render data will query the database.
+    """
+    index = (render_data or DeviceRenderData(device)).interface_index
 
     if isinstance(obj, VLAN):
-        vlan_filter = Q(untagged_vlan=obj) | Q(tagged_vlans=obj)
-        return device.interfaces.filter(vlan_filter).first()
+        return index.get_vlan_interface(obj)
+
+    network = prefixes_utils.to_network(obj)
 
     if include_vlans:
         # Get the vlan interface for this IP if the router has one
-        vlan_interface = VLAN.objects.filter(
-            interfaces_as_tagged__device=device,
-            prefixes__prefix__net_contains_or_equals=str(obj),
-        ).last()
+        vlan_interface = index.get_tagged_vlan(network)
         if vlan_interface:
             return vlan_interface
 
-    if obj.network.max_prefixlen == obj.network.prefixlen:
-        # A /32 or /128, so query based on the IP host
-        query = dict(ip_addresses__address__net_host=str(obj))
-    else:
-        # A subnet of some sort
-        query = dict(ip_addresses__address__net_contained_or_equal=str(obj))
-
     # Get the smallest matching subnet
-    return (
-        device.interfaces.filter(**query)
-        .order_by("ip_addresses__address__net_mask_length")
-        .last()
-    )
+    return index.get_address_interface(network)
 
 
-def get_prefix(ip_address, **extra_filters):
-    return (
-        Prefix.objects.filter(
-            prefix__net_contained_or_equal=str(ip_address), **extra_filters
-        )
-        .order_by("prefix__net_mask_length")
-        .last()
-    )
+def get_prefix(ip_address, render_data: DeviceRenderData = None, **extra_filters):
+    """Get the most specific prefix which contains (or is) the address/network"""
+    return get_prefixes([ip_address], render_data=render_data, **extra_filters)[0]
+
+
+def get_prefixes(
+    ip_addresses: Iterable, render_data: DeviceRenderData = None, **extra_filters
+) -> List[Optional[Prefix]]:
+    """Get the most specific prefix for each of many addresses/networks
+
+    Returns a prefix (or None) per address, in the order given. Lookups are
+    answered from the prefix index, so at most one query is needed to load
+    the prefixes found. Filtering by anything other than vrf/vrf_id requires
+    a query per address.
+    """
+    networks = [
+        prefixes_utils.to_network(ip)
+        for ip in prefixes_utils.iter_networks(ip_addresses)
+    ]
+
+    vrf_id = ANY_VRF
+    for key in ("vrf", "vrf_id"):
+        if key in extra_filters:
+            vrf = extra_filters.pop(key)
+            vrf_id = getattr(vrf, "pk", vrf)
+    if extra_filters:
+        if vrf_id is not ANY_VRF:
+            extra_filters["vrf_id"] = vrf_id
+        return [
+            Prefix.objects.filter(
+                prefix__net_contains_or_equals=str(network), **extra_filters
+            )
+            .order_by("prefix__net_mask_length")
+            .last()
+            for network in networks
+        ]
+
+    index = render_data.prefix_index if render_data else get_prefix_index()
+    pks = [index.get_covering(network, vrf_id=vrf_id) for network in networks]
+    found = {pk for pk in pks if pk is not None}
+    if render_data:
+        prefixes = render_data.get_prefixes_by_pk(found)
+    else:
+        prefixes = Prefix.objects.in_bulk(found) if found else {}
+    return [prefixes.get(pk) for pk in pks]
 
 
-def get_address(device: Device, interface: Union[Interface, VLAN], **extra_filters):
+def get_address(
+    device: Device,
+    interface: Union[Interface, VLAN],
+    render_data: DeviceRenderData = None,
+    **extra_filters,
+):
     if isinstance(interface, Interface):
         return interface.ip_addresses.filter(**extra_filters).first()
+    elif not extra_filters:
+        if render_data is None or render_data.device.pk != device.pk:
+            render_data = DeviceRenderData(device)
+        return render_data.vlan_address_index.get_address(interface)
     else:
         vlan_prefixes = [str(p.prefix) for p in interface.prefixes.all()]
         vlan_prefixes = Cast(vlan_prefixes, output_field=ArrayField(IPAddressField()))
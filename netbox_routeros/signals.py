@@ -0,0 +1,40 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from ipam.models import Prefix
+from netbox_routeros.dependencies import AFFECTED_BY, changed
+from netbox_routeros.indexes import invalidate_prefix_index
+from netbox_routeros.models import ConfigurationTemplate
+from netbox_routeros.ros_config_maker import invalidate_template_cache
+
+
+@receiver(post_save, sender=ConfigurationTemplate)
+@receiver(post_delete, sender=ConfigurationTemplate)
+def invalidate_compiled_templates(instance: ConfigurationTemplate, **kwargs):
+    invalidate_template_cache(instance.slug)
+
+
+@receiver(post_save, sender=Prefix)
+@receiver(post_delete, sender=Prefix)
+def invalidate_prefixes(**kwargs):
+    invalidate_prefix_index()
+
+
+def mark_affected_devices_stale(sender, instance, raw=False, **kwargs):
+    if raw:
+        # Loading fixtures
+        return
+    changed(sender, instance)
+
+
+for model in AFFECTED_BY:
+    post_save.connect(
+        mark_affected_devices_stale,
+        sender=model,
+        dispatch_uid=f"routeros_stale_{model._meta.label_lower}_save",
+    )
+    post_delete.connect(
+        mark_affected_devices_stale,
+        sender=model,
+        dispatch_uid=f"routeros_stale_{model._meta.label_lower}_delete",
+    )
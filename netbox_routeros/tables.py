@@ -1,4 +1,4 @@
-from django_tables2 import tables, TemplateColumn, Column
+from django_tables2 import TemplateColumn, Column
 
 from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice
 from netbox_routeros.template_code import (
@@ -11,6 +11,7 @@ from netbox_routeros.utilities.tables import TagColumn
 from tenancy.tables import COL_TENANT
 from utilities.tables import (
     BaseTable,
+    BooleanColumn,
     ToggleColumn,
 )
 
@@ -29,6 +30,8 @@ class ConfiguredDeviceTable(BaseTable):
         linkify=True, accessor="device.primary_ip6", verbose_name="IPv6 Address"
     )
     tags = TagColumn(accessor="device.tags", url_name="dcim:device_list")
+    in_sync = BooleanColumn(verbose_name="In sync")
+    drift_commands = Column(verbose_name="Drift")
 
     actions = TemplateColumn(template_code=CONFIGURED_DEVICE_BUTTONS,)
 
@@ -43,6 +46,10 @@ class ConfiguredDeviceTable(BaseTable):
             "tags",
             "last_config_fetched_at",
             "last_config_pushed_at",
+            "in_sync",
+            "drift_commands",
+            "drift_checked_at",
+            "stale_since",
             "actions",
         )
         default_columns = (
@@ -53,6 +60,7 @@ class ConfiguredDeviceTable(BaseTable):
             "tags",
             "last_config_fetched_at",
             "last_config_pushed_at",
+            "in_sync",
             "actions",
         )
 
@@ -1,12 +1,27 @@
-from ipaddress import IPv4Address, IPv6Address
-from typing import Sequence, Union
+from dataclasses import dataclass, field
+from ipaddress import IPv4Address, IPv6Address, ip_network
+from typing import List, Sequence, Union
 
 from dcim.models import Site, DeviceRole, DeviceType, Device, Manufacturer, Interface
+from ipam.constants import VLAN_VID_MAX
 from ipam.models import IPAddress, Prefix, VLAN
+from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice
 
 FlexibleIpType = Union[str, IPv4Address, IPv6Address, IPAddress]
 
 
+@dataclass
+class Fleet:
+    """The objects created by DataProvider.fleet()"""
+
+    devices: List[Device] = field(default_factory=list)
+    interfaces: List[Interface] = field(default_factory=list)
+    ip_addresses: List[IPAddress] = field(default_factory=list)
+    prefixes: List[Prefix] = field(default_factory=list)
+    vlans: List[VLAN] = field(default_factory=list)
+    configured_devices: List[ConfiguredDevice] = field(default_factory=list)
+
+
 class TestCaseMixin:
     data: "DataProvider"
 
@@ -156,7 +171,7 @@ class DataProvider:
 
     def prefix(self, prefix: str = None, **kwargs):
         number = Prefix.objects.count()
-        values = dict(prefix=prefix or f"10.123.{number}.0/24",)
+        values = dict(prefix=prefix or f"10.123.{number}.0/24", **kwargs)
         return Prefix.objects.create(**values)
 
     def vlan(self, vid: int = None, name: str = None):
@@ -171,3 +186,130 @@ class DataProvider:
         number = IPAddress.objects.count()
         values = dict(address=address or f"10.99.99.{number}", **kwargs)
         return IPAddress.objects.create(**values)
+
+    def configuration_template(
+        self, name: str = None, slug: str = None, content: str = "", **kwargs
+    ):
+        number = ConfigurationTemplate.objects.count() + 1
+        values = dict(
+            name=name or f"Test configuration template {number}",
+            slug=slug or f"test-configuration-template-{number}",
+            content=content,
+            **kwargs,
+        )
+        return ConfigurationTemplate.objects.create(**values)
+
+    def configured_device(
+        self,
+        device: Device = None,
+        configuration_template: ConfigurationTemplate = None,
+        **kwargs,
+    ):
+        values = dict(
+            device=device or self.device(),
+            configuration_template=configuration_template
+            or self.configuration_template(),
+            **kwargs,
+        )
+        return ConfiguredDevice.objects.create(**values)
+
+    def fleet(
+        self,
+        devices: int,
+        interfaces: int = 1,
+        prefixes: int = 0,
+        vlans: int = 0,
+        configuration_template: ConfigurationTemplate = None,
+        name: str = "device",
+        network: str = "10.0.0.0/8",
+    ) -> Fleet:
+        """Create many devices at once, using a fixed number of queries
+
+        Device n is named '{name}-{n}', and its interfaces are named ether1,
+        ether2, etc. Each device is allocated the nth /24 of network, and each
+        of its interfaces has the first address of the next /30 within that.
+        The first `prefixes` of each device's /30s have a Prefix, and the first
+        `vlans` of those prefixes are assigned a VLAN. VLAN IDs are numbered
+        sequentially across the fleet, starting at 2.
+
+        If a configuration template is given then a ConfiguredDevice is also
+        created for each device.
+
+        Objects are created using bulk_create(), so their save() methods &
+        signals are not called.
+        """
+        if interfaces > 64:
+            raise ValueError("At most 64 interfaces per device are supported")
+        if vlans > prefixes:
+            raise ValueError("VLANs are assigned to prefixes, so cannot exceed them")
+        if devices * vlans > VLAN_VID_MAX - 1:
+            raise ValueError(
+                f"{devices * vlans} VLANs were requested, but only VLAN IDs "
+                f"2-{VLAN_VID_MAX} are available"
+            )
+
+        network = ip_network(network)
+        if devices > 2 ** (24 - network.prefixlen):
+            raise ValueError(f"{network} does not have a /24 for each device")
+
+        subnets = network.subnets(new_prefix=24)
+        device_subnets = [next(subnets) for _ in range(devices)]
+        defaults = dict(
+            device_type=self.any_device_type(),
+            device_role=self.any_device_role(),
+            site=self.any_site(),
+        )
+
+        fleet = Fleet()
+        fleet.devices = Device.objects.bulk_create(
+            [Device(name=f"{name}-{n}", **defaults) for n in range(devices)]
+        )
+        fleet.interfaces = Interface.objects.bulk_create(
+            [
+                Interface(device=device, name=f"ether{i + 1}")
+                for device in fleet.devices
+                for i in range(interfaces)
+            ]
+        )
+        fleet.vlans = VLAN.objects.bulk_create(
+            [
+                VLAN(vid=vid, name=f"{name} VLAN {vid}")
+                for vid in range(2, 2 + devices * vlans)
+            ]
+        )
+
+        ip_addresses = []
+        fleet_prefixes = []
+        vlans_iter = iter(fleet.vlans)
+        for n, device in enumerate(fleet.devices):
+            subnets = device_subnets[n].subnets(new_prefix=30)
+            device_interfaces = fleet.interfaces[n * interfaces : (n + 1) * interfaces]
+            for i, interface in enumerate(device_interfaces):
+                subnet = next(subnets)
+                ip_addresses.append(
+                    IPAddress(
+                        address=f"{subnet[1]}/{subnet.prefixlen}",
+                        assigned_object=interface,
+                    )
+                )
+                if i < prefixes:
+                    fleet_prefixes.append(
+                        Prefix(
+                            prefix=str(subnet),
+                            vlan=next(vlans_iter) if i < vlans else None,
+                        )
+                    )
+        fleet.ip_addresses = IPAddress.objects.bulk_create(ip_addresses)
+        fleet.prefixes = Prefix.objects.bulk_create(fleet_prefixes)
+
+        if configuration_template:
+            fleet.configured_devices = ConfiguredDevice.objects.bulk_create(
+                [
+                    ConfiguredDevice(
+                        device=device, configuration_template=configuration_template
+                    )
+                    for device in fleet.devices
+                ]
+            )
+
+        return fleet
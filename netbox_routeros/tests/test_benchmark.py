@@ -0,0 +1,21 @@
+import json
+
+from netbox_routeros.benchmark import build_fleet, run_benchmark
+from utilities.testing import TestCase
+
+
+class BenchmarkTestCase(TestCase):
+    def test_benchmark(self):
+        devices = build_fleet(devices=2, interfaces=3, prefixes=2, vlans=1)
+        self.assertEqual(devices[1].interfaces.count(), 3)
+
+        results = run_benchmark(devices, repeat=2)
+
+        # Must be serialisable
+        json.dumps(results)
+        self.assertEqual(results["per_device"]["render"]["count"], 4)
+        self.assertEqual(results["per_batch"]["render_many"]["count"], 2)
+        self.assertGreater(results["per_device"]["config_lines"]["min"], 0)
+        # The data is loaded in the context stage. At most the check for
+        # changed templates remains
+        self.assertLessEqual(results["per_device"]["render_queries"]["max"], 1)
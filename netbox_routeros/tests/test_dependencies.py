@@ -0,0 +1,146 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from netbox_routeros.dependencies import deferred_stale_marking
+from netbox_routeros.testing import TestCaseMixin
+from utilities.testing import TestCase
+
+
+TEMPLATE = """/ip address
+{% for prefix in prefixes %}add address={{ prefix.prefix }} interface={{ prefix.vlan }}
+{% endfor %}"""
+
+
+class StaleDevicesTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        configuration_template = self.data.configuration_template(content=TEMPLATE)
+        self.configured_device1 = self.data.configured_device(
+            configuration_template=configuration_template,
+            last_config_fetched="/system identity\nset name=a",
+        )
+        self.configured_device2 = self.data.configured_device(
+            configuration_template=configuration_template,
+            last_config_fetched="/system identity\nset name=b",
+        )
+        self.data.interface(
+            device=self.configured_device1.device, ip_address="10.0.0.1/24"
+        )
+        self.data.interface(
+            device=self.configured_device2.device, ip_address="10.1.0.1/24"
+        )
+        self.prefix1 = self.data.prefix("10.0.0.0/24")
+        self.prefix2 = self.data.prefix("10.1.0.0/24")
+
+        for configured_device in (self.configured_device1, self.configured_device2):
+            configured_device.check_drift()
+
+    def assertStale(self, *configured_devices):
+        stale = []
+        for configured_device in (self.configured_device1, self.configured_device2):
+            configured_device.refresh_from_db()
+            if configured_device.stale_since:
+                stale.append(configured_device)
+        self.assertEqual(stale, list(configured_devices))
+
+    def test_not_stale_once_checked(self):
+        self.assertStale()
+        self.assertEqual(
+            self.configured_device1.render_dependencies["objects"]["ipam.prefix"],
+            [self.prefix1.pk],
+        )
+
+    def test_prefix_changed(self):
+        self.prefix1.description = "Changed"
+        self.prefix1.save()
+        self.assertStale(self.configured_device1)
+
+    def test_prefix_created(self):
+        self.data.prefix("10.0.0.0/16")
+        self.assertStale(self.configured_device1)
+
+    def test_prefix_deleted(self):
+        self.prefix2.delete()
+        self.assertStale(self.configured_device2)
+
+    def test_vlan_changed(self):
+        vlan = self.data.vlan()
+        self.prefix2.vlan = vlan
+        self.prefix2.save()
+        self.configured_device2.check_drift()
+        self.assertStale()
+
+        vlan.name = "Changed"
+        vlan.save()
+        self.assertStale(self.configured_device2)
+
+    def test_ip_address_added(self):
+        self.data.interface(
+            device=self.configured_device2.device, ip_address="10.2.0.1/24"
+        )
+        self.assertStale(self.configured_device2)
+
+    def test_model_queried_by_template(self):
+        self.configured_device1.extra_configuration = (
+            "{% set count = Prefix.objects.count() %}"
+        )
+        self.configured_device1.check_drift()
+        self.assertStale()
+
+        self.data.prefix("192.168.0.0/24")
+        self.assertStale(self.configured_device1)
+
+    def test_template_changed(self):
+        self.configured_device1.configuration_template.content = "/system identity"
+        self.configured_device1.configuration_template.save()
+        # Both devices use the template
+        self.assertStale(self.configured_device1, self.configured_device2)
+
+    def test_extra_configuration_changed(self):
+        self.configured_device1.extra_configuration = "/system identity"
+        self.configured_device1.save()
+        self.assertStale(self.configured_device1)
+
+    def test_saved_without_render_changes(self):
+        self.configured_device1.last_config_fetched = "/system identity\nset name=c"
+        self.configured_device1.save(update_fields=["last_config_fetched"])
+        self.configured_device2.save()
+        self.assertStale()
+
+    def test_template_switched(self):
+        self.configured_device1.configuration_template = (
+            self.data.configuration_template()
+        )
+        self.configured_device1.save()
+        self.assertStale(self.configured_device1)
+
+    def test_deferred(self):
+        with CaptureQueriesContext(connection) as queries:
+            with deferred_stale_marking():
+                for prefix in (self.prefix1, self.prefix2):
+                    prefix.description = "Changed"
+                    prefix.save()
+                    prefix.save()
+                self.assertStale()
+        self.assertStale(self.configured_device1, self.configured_device2)
+
+        # One update for both prefixes
+        updates = [
+            q["sql"]
+            for q in queries.captured_queries
+            if q["sql"].startswith('UPDATE "netbox_routeros_configureddevice"')
+        ]
+        self.assertEqual(len(updates), 1)
+
+    def test_deferred_deleted(self):
+        with deferred_stale_marking():
+            self.prefix2.delete()
+        self.assertStale(self.configured_device2)
+
+    def test_deferred_not_marked_on_error(self):
+        with self.assertRaises(ValueError):
+            with deferred_stale_marking():
+                self.prefix1.description = "Changed"
+                self.prefix1.save()
+                raise ValueError()
+        self.assertStale()
@@ -0,0 +1,155 @@
+import time
+
+from netbox_routeros.fleet import (
+    run_for_devices,
+    DeviceResult,
+    plan_waves,
+    push_configs,
+)
+from utilities.testing import TestCase
+
+
+class FakeConfiguredDevice:
+    def __init__(self, name, problems=None):
+        self.name = name
+        self.problems = problems or []
+
+    def __str__(self):
+        return self.name
+
+    def push_config(self):
+        if self.name.startswith("bad"):
+            raise ValueError("Boom")
+
+
+class RunForDevicesTestCase(TestCase):
+    def test_results(self):
+        def operation(configured_device):
+            if configured_device.name == "bad":
+                raise ValueError("Boom")
+
+        devices = [
+            FakeConfiguredDevice("good"),
+            FakeConfiguredDevice("bad"),
+            FakeConfiguredDevice("broken", problems=["No platform"]),
+        ]
+        results = run_for_devices(devices, operation, workers=2, timeout=10)
+
+        self.assertEqual(
+            [r.status for r in results],
+            [DeviceResult.SUCCESS, DeviceResult.FAILED, DeviceResult.SKIPPED],
+        )
+        self.assertEqual(results[1].error, "ValueError: Boom")
+        self.assertEqual(results[2].error, "No platform")
+        self.assertIsNotNone(results[0].duration)
+
+    def test_slow_device_does_not_block_others(self):
+        def operation(configured_device):
+            if configured_device.name == "slow":
+                time.sleep(2)
+
+        reported = []
+        devices = [FakeConfiguredDevice("slow")] + [
+            FakeConfiguredDevice(f"fast{i}") for i in range(5)
+        ]
+        start = time.monotonic()
+        results = run_for_devices(
+            devices,
+            operation,
+            workers=2,
+            timeout=0.2,
+            on_result=lambda r: reported.append(
+                (str(r.configured_device), r.status, time.monotonic() - start)
+            ),
+        )
+
+        # The fast devices were reported long before the slow one finished
+        fast = [t for name, _, t in reported if name.startswith("fast")]
+        self.assertEqual(len(fast), 5)
+        self.assertLess(max(fast), 1.5)
+        self.assertTrue(all(r.success for r in results[1:]))
+
+        # The slow device was reported as timed out, then waited for
+        slow = [(status, t) for name, status, t in reported if name == "slow"]
+        self.assertEqual(
+            [status for status, _ in slow],
+            [DeviceResult.TIMEOUT, DeviceResult.SUCCESS],
+        )
+        self.assertGreaterEqual(time.monotonic() - start, 2)
+        self.assertEqual(results[0].status, DeviceResult.SUCCESS)
+
+
+class PushConfigsTestCase(TestCase):
+    def test_plan_waves(self):
+        self.assertEqual(plan_waves(100, 1, 4), [1, 4, 16, 64, 15])
+        self.assertEqual(plan_waves(3, 5, 2), [3])
+        self.assertEqual(plan_waves(0, 1, 4), [])
+
+    def test_all_pushed(self):
+        devices = [FakeConfiguredDevice(f"good{i}") for i in range(10)]
+        results = push_configs(
+            devices, workers=4, timeout=10, canary_size=1, wave_growth=2
+        )
+        self.assertTrue(all(r.success for r in results))
+
+    def test_canary_failure_stops_rollout(self):
+        devices = [FakeConfiguredDevice("bad0")] + [
+            FakeConfiguredDevice(f"good{i}") for i in range(10)
+        ]
+        results = push_configs(
+            devices,
+            workers=4,
+            timeout=10,
+            canary_size=1,
+            wave_growth=2,
+            max_error_rate=0.1,
+        )
+        self.assertEqual(results[0].status, DeviceResult.FAILED)
+        self.assertEqual(len(results), 11)
+        self.assertTrue(all(r.status == DeviceResult.SKIPPED for r in results[1:]))
+
+    def test_error_rate_tolerated(self):
+        devices = [FakeConfiguredDevice(f"good{i}") for i in range(9)] + [
+            FakeConfiguredDevice("bad0")
+        ]
+        results = push_configs(
+            devices,
+            workers=4,
+            timeout=10,
+            canary_size=1,
+            wave_growth=2,
+            max_error_rate=0.5,
+        )
+        self.assertEqual(len([r for r in results if r.success]), 9)
+
+    def test_timed_out_push_finishes_before_next_wave(self):
+        running = []
+        overlapped = []
+
+        class SlowConfiguredDevice(FakeConfiguredDevice):
+            def push_config(self):
+                if "slow" in running:
+                    overlapped.append(self.name)
+                running.append(self.name)
+                time.sleep(1.2 if self.name == "slow" else 0)
+                running.remove(self.name)
+
+        reported = []
+        devices = [SlowConfiguredDevice("slow")] + [
+            SlowConfiguredDevice(f"good{i}") for i in range(4)
+        ]
+        results = push_configs(
+            devices,
+            workers=2,
+            timeout=0.1,
+            canary_size=1,
+            wave_growth=4,
+            on_result=lambda r: reported.append((str(r.configured_device), r.status)),
+        )
+        self.assertEqual(overlapped, [])
+        self.assertEqual(
+            reported[:2],
+            [("slow", DeviceResult.TIMEOUT), ("slow", DeviceResult.SUCCESS)],
+        )
+        # A timeout is not a failure, so the next wave was still pushed
+        self.assertTrue(all(r.success for r in results))
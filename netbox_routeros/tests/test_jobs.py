@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+from django.utils.timezone import now
+
+from netbox_routeros.jobs import (
+    JOB_TIMEOUT_MARGIN,
+    fail_stuck_jobs,
+    get_job_timeout,
+    run_config_job,
+)
+from netbox_routeros.models import ConfigJob, ConfigJobDevice
+from netbox_routeros.testing import TestCaseMixin
+from utilities.testing import TestCase
+
+
+class RunConfigJobTestCase(TestCaseMixin, TestCase):
+    def test_devices_with_problems_are_skipped(self):
+        configured_device1 = self.data.configured_device()
+        configured_device2 = self.data.configured_device()
+
+        job = ConfigJob.objects.create(kind=ConfigJob.KIND_FETCH)
+        for configured_device in (configured_device1, configured_device2):
+            ConfigJobDevice.objects.create(job=job, configured_device=configured_device)
+
+        run_config_job(job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ConfigJob.STATUS_COMPLETED)
+        self.assertIsNotNone(job.started_at)
+        self.assertIsNotNone(job.completed_at)
+        self.assertTrue(job.finished)
+
+        for job_device in job.devices.all():
+            self.assertEqual(job_device.status, "skipped")
+            self.assertIn("No platform", job_device.error)
+            self.assertIsNotNone(job_device.completed_at)
+
+
+class JobTimeoutTestCase(TestCaseMixin, TestCase):
+    def test_push_timeout_covers_every_wave(self):
+        # Waves of 1, 4, 16 & 9 devices, pushed 10 at a time
+        self.assertEqual(
+            get_job_timeout(ConfigJob.KIND_PUSH, 30), 5 * 300 + JOB_TIMEOUT_MARGIN,
+        )
+
+    def test_fetch_timeout(self):
+        self.assertEqual(
+            get_job_timeout(ConfigJob.KIND_FETCH, 25), 3 * 120 + JOB_TIMEOUT_MARGIN
+        )
+
+    def test_stuck_job_failed(self):
+        configured_device = self.data.configured_device()
+        stuck = ConfigJob.objects.create(
+            kind=ConfigJob.KIND_FETCH,
+            status=ConfigJob.STATUS_RUNNING,
+            started_at=now() - timedelta(days=1),
+        )
+        running = ConfigJob.objects.create(
+            kind=ConfigJob.KIND_FETCH,
+            status=ConfigJob.STATUS_RUNNING,
+            started_at=now(),
+        )
+        for job in (stuck, running):
+            ConfigJobDevice.objects.create(job=job, configured_device=configured_device)
+
+        self.assertEqual(fail_stuck_jobs(), 1)
+        stuck.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual(stuck.status, ConfigJob.STATUS_FAILED)
+        self.assertIn("most likely killed", stuck.error)
+        self.assertIsNotNone(stuck.completed_at)
+        self.assertEqual(running.status, ConfigJob.STATUS_RUNNING)
@@ -0,0 +1,275 @@
+import pickle
+import zlib
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import override_settings
+
+from netbox_routeros.models import ConfiguredDevice
+from netbox_routeros.testing import TestCaseMixin
+from netbox_routeros.utilities.parsed_config import load_config
+from utilities.testing import TestCase
+
+TEMPLATE = """/ip address
+{% for ip in ip_addresses %}add address={{ ip.address }} interface=ether1
+{% endfor %}"""
+
+
+class GenerateConfigCacheTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.configured_device = self.data.configured_device(
+            configuration_template=self.data.configuration_template(content=TEMPLATE)
+        )
+        self.device = self.configured_device.device
+        self.data.interface(device=self.device, ip_address="10.0.0.1/24")
+
+    def test_cached(self):
+        config = self.configured_device.generate_config(use_cache=True)
+        with patch("netbox_routeros.models.render_ros_config") as render:
+            self.assertEqual(
+                str(self.configured_device.generate_config(use_cache=True)),
+                str(config),
+            )
+        render.assert_not_called()
+
+    def test_rerendered_when_addresses_change(self):
+        config1 = self.configured_device.generate_config(use_cache=True)
+        self.data.interface(device=self.device, ip_address="10.0.1.1/24")
+        config2 = self.configured_device.generate_config(use_cache=True)
+
+        self.assertNotIn("10.0.1.1/24", str(config1))
+        self.assertIn("10.0.1.1/24", str(config2))
+
+    def test_rerendered_when_template_changes(self):
+        self.configured_device.generate_config(use_cache=True)
+        self.configured_device.extra_configuration = "/system identity"
+        config = self.configured_device.generate_config(use_cache=True)
+        self.assertIn("/system identity", config.keys())
+
+    def test_rerendered_when_included_template_changes(self):
+        include = self.data.configuration_template(
+            slug="identity", content="/system identity\nset name=a"
+        )
+        self.configured_device.configuration_template.content = (
+            "{% include 'identity' %}"
+        )
+        self.configured_device.configuration_template.save()
+        self.configured_device.generate_config(use_cache=True)
+
+        include.content = "/system identity\nset name=b"
+        include.save()
+        config = self.configured_device.generate_config(use_cache=True)
+        self.assertIn("set name=b", str(config))
+
+    def test_rerendered_when_interfaces_change(self):
+        self.configured_device.configuration_template.content = (
+            "/interface ethernet\n"
+            "set [ find default-name={{ get_interface('10.0.0.1') }} ] comment=x"
+        )
+        self.configured_device.configuration_template.save()
+        self.configured_device.generate_config(use_cache=True)
+
+        interface = self.device.interfaces.get()
+        interface.name = "renamed"
+        interface.save()
+        config = self.configured_device.generate_config(use_cache=True)
+        self.assertIn("renamed", str(config))
+
+    def test_not_cached_by_default(self):
+        self.configured_device.generate_config(use_cache=True)
+        with patch(
+            "netbox_routeros.models.render_ros_config", return_value=""
+        ) as render:
+            self.configured_device.generate_config()
+        render.assert_called_once()
+
+    def test_diff_reuses_given_config(self):
+        self.configured_device.last_config_fetched = "/system identity\nset name=a"
+        config = self.configured_device.generate_config()
+        with patch("netbox_routeros.models.render_ros_config") as render:
+            diff = self.configured_device.generate_diff(config=config)
+        render.assert_not_called()
+        self.assertIn("/ip address", diff.keys())
+
+
+class ParsedConfigTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.configured_device = self.data.configured_device(
+            configuration_template=self.data.configuration_template(content=TEMPLATE)
+        )
+        self.configured_device.last_config_fetched = "/system identity\nset name=a"
+        self.configured_device.save()
+
+    def test_parsed_once(self):
+        self.configured_device.parse_last_config_fetched()
+        self.configured_device.refresh_from_db()
+        with patch("netbox_routeros.models.RouterOSConfig.parse") as parse:
+            config = self.configured_device.parse_last_config_fetched()
+        parse.assert_not_called()
+        self.assertIn("/system identity", config.keys())
+
+    def test_reparsed_when_text_changes(self):
+        self.configured_device.parse_last_config_fetched()
+        self.configured_device.last_config_fetched = "/system identity\nset name=b"
+        config = self.configured_device.parse_last_config_fetched()
+        self.assertIn("name=b", str(config))
+
+    def test_reparsed_when_parser_changes(self):
+        self.configured_device.parse_last_config_fetched()
+        with patch("netbox_routeros.utilities.parsed_config.PARSER_VERSION", "x"):
+            self.assertIsNone(
+                load_config(
+                    self.configured_device.last_config_parsed,
+                    self.configured_device.last_config_fetched,
+                )
+            )
+
+    def test_unsigned_not_loaded(self):
+        self.configured_device.parse_last_config_fetched()
+        key, signature, data = bytes(self.configured_device.last_config_parsed).split(
+            b"\n", 2
+        )
+        tampered = key + b"\n" + signature + b"\n" + zlib.compress(pickle.dumps(None))
+        with patch("netbox_routeros.utilities.parsed_config.pickle.loads") as loads:
+            self.assertIsNone(
+                load_config(tampered, self.configured_device.last_config_fetched)
+            )
+        loads.assert_not_called()
+
+    def test_signed_with_other_key_not_loaded(self):
+        self.configured_device.parse_last_config_fetched()
+        with override_settings(SECRET_KEY="another-secret-key-" * 3):
+            self.assertIsNone(
+                load_config(
+                    self.configured_device.last_config_parsed,
+                    self.configured_device.last_config_fetched,
+                )
+            )
+
+
+class CheckDriftTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.configured_device = self.data.configured_device(
+            configuration_template=self.data.configuration_template(content=TEMPLATE)
+        )
+        self.data.interface(
+            device=self.configured_device.device, ip_address="10.0.0.1/24"
+        )
+
+    def test_not_fetched(self):
+        self.configured_device.check_drift()
+        self.configured_device.refresh_from_db()
+        self.assertIsNone(self.configured_device.in_sync)
+        self.assertIsNotNone(self.configured_device.drift_checked_at)
+
+    def test_in_sync(self):
+        self.configured_device.last_config_fetched = (
+            "/ip address\nadd address=10.0.0.1/24 interface=ether1"
+        )
+        self.configured_device.check_drift()
+        self.configured_device.refresh_from_db()
+        self.assertIs(self.configured_device.in_sync, True)
+        self.assertEqual(self.configured_device.drift_commands, 0)
+        self.assertEqual(self.configured_device.drift_sections, [])
+
+    def test_drifted(self):
+        self.configured_device.last_config_fetched = "/system identity\nset name=a"
+        self.configured_device.save()
+        self.configured_device.check_drift()
+
+        self.assertQuerysetEqual(
+            ConfiguredDevice.objects.filter(in_sync=False),
+            [self.configured_device.pk],
+            transform=lambda cd: cd.pk,
+        )
+        self.configured_device.refresh_from_db()
+        self.assertEqual(self.configured_device.drift_commands, 1)
+        self.assertEqual(self.configured_device.drift_sections, ["/ip address"])
+        self.assertEqual(len(self.configured_device.drift_hash), 64)
+
+    def test_render_error(self):
+        self.configured_device.last_config_fetched = "/system identity\nset name=a"
+        self.configured_device.extra_configuration = "{{ foo("
+        with self.assertRaises(Exception):
+            self.configured_device.check_drift()
+        self.configured_device.refresh_from_db()
+        self.assertIsNone(self.configured_device.in_sync)
+        self.assertIn("TemplateSyntaxError", self.configured_device.drift_error)
+
+
+class FakeDriver:
+    def __init__(self):
+        self.get_config_calls = []
+        self.pushed = None
+
+    def get_config(self, retrieve, full, sanitized):
+        self.get_config_calls.append(full)
+        config = "/system identity\nset name=a"
+        if full:
+            config += "\n/system note\nset show-at-login=yes"
+        return {"running": config}
+
+    def load_replace_candidate(self, config, **kwargs):
+        self.pushed = config
+
+
+class FetchPushConfigTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.configured_device = self.data.configured_device(
+            configuration_template=self.data.configuration_template(content=TEMPLATE)
+        )
+        self.drivers = []
+
+        @contextmanager
+        def napalm_session(device):
+            self.drivers.append(FakeDriver())
+            yield self.drivers[-1]
+
+        patcher = patch("netbox_routeros.models.napalm_session", napalm_session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetch_uses_one_driver(self):
+        self.configured_device.fetch_config()
+        self.assertEqual(len(self.drivers), 1)
+        self.assertEqual(self.drivers[0].get_config_calls, [False, True])
+
+        self.configured_device.refresh_from_db()
+        self.assertIn(
+            "show-at-login", self.configured_device.last_verbose_config_fetched
+        )
+        self.assertIsNotNone(self.configured_device.last_verbose_config_parsed)
+
+    def test_fetch_saves_fetched_fields_only(self):
+        # As if edited by another process after this one loaded the device
+        ConfiguredDevice.objects.filter(pk=self.configured_device.pk).update(
+            extra_configuration="/system note"
+        )
+        self.configured_device.fetch_config()
+        self.configured_device.refresh_from_db()
+        self.assertEqual(self.configured_device.extra_configuration, "/system note")
+        self.assertIsNotNone(self.configured_device.last_config_fetched_at)
+
+    def test_push_refreshes_terse_config_only(self):
+        self.configured_device.last_verbose_config_fetched = "/system note"
+        self.configured_device.save()
+
+        self.configured_device.push_config()
+        self.assertEqual(len(self.drivers), 1)
+        self.assertIsNotNone(self.drivers[0].pushed)
+        self.assertEqual(self.drivers[0].get_config_calls, [False])
+
+        self.configured_device.refresh_from_db()
+        self.assertEqual(
+            self.configured_device.last_config_fetched, "/system identity\nset name=a"
+        )
+        self.assertEqual(
+            self.configured_device.last_verbose_config_fetched, "/system note"
+        )
+        self.assertIsNotNone(self.configured_device.last_config_pushed_at)
@@ -0,0 +1,138 @@
+from unittest.mock import patch
+
+from netbox_routeros.utilities.napalm import NapalmDriverPool
+from utilities.testing import TestCase
+
+
+class FakeDevice:
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class FakeDriver:
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.alive = True
+
+    def open(self):
+        self.opened += 1
+
+    def close(self):
+        self.closed += 1
+
+    def is_alive(self):
+        return {"is_alive": self.alive}
+
+
+class UnopenableDriver(FakeDriver):
+    """As if the device's RouterOS API service were disabled"""
+
+    def open(self):
+        super().open()
+        raise ConnectionRefusedError()
+
+
+@patch(
+    "netbox_routeros.utilities.napalm._get_connection_args",
+    lambda device: {"hostname": f"10.0.0.{device.pk}"},
+)
+@patch(
+    "netbox_routeros.utilities.napalm.get_napalm_driver", lambda device: FakeDriver(),
+)
+class NapalmDriverPoolTestCase(TestCase):
+    def test_reused(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=True)
+        device = FakeDevice(1)
+        with pool.connection(device) as driver1:
+            pass
+        with pool.connection(device) as driver2:
+            pass
+
+        self.assertIs(driver1, driver2)
+        self.assertEqual(driver1.opened, 1)
+        self.assertEqual(driver1.closed, 0)
+
+    def test_per_device(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=True)
+        with pool.connection(FakeDevice(1)) as driver1:
+            pass
+        with pool.connection(FakeDevice(2)) as driver2:
+            pass
+        self.assertIsNot(driver1, driver2)
+
+    def test_dead_connection_replaced(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=True)
+        device = FakeDevice(1)
+        with pool.connection(device) as driver1:
+            driver1.alive = False
+        with pool.connection(device) as driver2:
+            pass
+
+        self.assertIsNot(driver1, driver2)
+        self.assertEqual(driver1.closed, 1)
+
+    def test_idle_evicted(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=True)
+        device = FakeDevice(1)
+        with pool.connection(device) as driver1:
+            pass
+
+        pool._idle_timeout = -1
+        pool.evict_idle()
+        self.assertEqual(driver1.closed, 1)
+
+    def test_error_discards_connection(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=True)
+        device = FakeDevice(1)
+        with self.assertRaises(ValueError):
+            with pool.connection(device) as driver1:
+                raise ValueError()
+        with pool.connection(device) as driver2:
+            pass
+
+        self.assertIsNot(driver1, driver2)
+        self.assertEqual(driver1.closed, 1)
+
+    def test_pooling_disabled(self):
+        pool = NapalmDriverPool(idle_timeout=0, open_sessions=True)
+        with pool.connection(FakeDevice(1)) as driver:
+            pass
+        self.assertEqual(driver.closed, 1)
+
+    def test_not_opened_without_sessions(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=False)
+        device = FakeDevice(1)
+        with pool.connection(device) as driver1:
+            pass
+        with pool.connection(device) as driver2:
+            pass
+
+        self.assertIs(driver1, driver2)
+        self.assertEqual(driver1.opened, 0)
+        pool.close_all()
+        self.assertEqual(driver1.closed, 0)
+
+
+@patch(
+    "netbox_routeros.utilities.napalm._get_connection_args",
+    lambda device: {"hostname": f"10.0.0.{device.pk}"},
+)
+@patch(
+    "netbox_routeros.utilities.napalm.get_napalm_driver",
+    lambda device: UnopenableDriver(),
+)
+class UnopenableDriverTestCase(TestCase):
+    def test_usable_without_sessions(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=False)
+        with pool.connection(FakeDevice(1)) as driver:
+            self.assertEqual(driver.opened, 0)
+
+    def test_open_failure_not_pooled(self):
+        pool = NapalmDriverPool(idle_timeout=60, open_sessions=True)
+        device = FakeDevice(1)
+        for _ in range(2):
+            with self.assertRaises(ConnectionRefusedError):
+                with pool.connection(device):
+                    self.fail("Should not be reached")
+        self.assertEqual(pool._connections, {})
@@ -1,12 +1,35 @@
+import pickle
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 from netaddr import IPAddress, IPNetwork
 
-from ipam.models import Prefix
+from extras.models import ConfigContext
+from ipam.models import IPAddress as IPAddressModel, Prefix, VLAN, VRF
+from netbox_routeros.indexes import invalidate_prefix_index
+from netbox_routeros.models import ConfigurationTemplate
 from netbox_routeros.ros_config_maker import (
-    _context_prefixes,
+    get_address,
     get_interface,
+    get_prefix,
+    get_prefixes,
     combine_prefixes,
     get_loopback,
+    get_template,
+    make_ros_config_context,
+    render_ros_config,
+    render_ros_config_many,
+    render_ros_config_parallel,
+    intersect_prefixes,
+    subtract_prefixes,
+    supernet_prefixes,
+    template_models,
 )
+from netbox_routeros.render_data import DeviceRenderData, load_render_data
+from netbox_routeros.render_profiler import RenderProfiler
+from netbox_routeros.render_recorder import RenderRecorder
 from netbox_routeros.testing import TestCaseMixin
 from utilities.testing import TestCase
 
@@ -16,6 +39,84 @@ class TestContextData(TestCaseMixin, TestCase):
         pass
 
 
+class MakeRosConfigContextTestCase(TestCaseMixin, TestCase):
+    def test_models_available_on_demand(self):
+        device = self.data.device()
+        context = make_ros_config_context(device)
+        self.assertNotIn("VLAN", context)
+        self.data.vlan()
+        config = render_ros_config(
+            device,
+            template_name="test",
+            template_content="{{ VLAN.objects.count() }} {{ Device.__name__ }}",
+            context=context,
+        )
+        self.assertEqual(config, "1 Device")
+
+    def test_config_context(self):
+        ConfigContext.objects.create(name="test", data={"ntp": {"server": "a"}})
+        context = make_ros_config_context(self.data.device())
+        self.assertEqual(context["ntp"], {"server": "a"})
+        self.assertIn("get_prefix", context)
+
+    def test_config_context_overrides(self):
+        ConfigContext.objects.create(
+            name="test", data={"vlans": ["custom"], "get_prefix": "custom"}
+        )
+        device = self.data.device()
+        context = make_ros_config_context(device)
+        self.assertEqual(context["vlans"], ["custom"])
+        self.assertEqual(context["get_prefix"], "custom")
+        self.assertEqual(context["device"], device)
+
+    def test_template_models(self):
+        self.assertIs(template_models["VLAN"], VLAN)
+        self.assertIn("Device", template_models)
+        self.assertNotIn("NotAModel", template_models)
+
+
+class DeviceRenderDataTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.data.device()
+        self.vlan1 = self.data.vlan()
+        self.data.interface(
+            device=self.device, ip_address=["10.0.0.1/24", "2001:db8::1/64"]
+        )
+        self.prefix_v4 = self.data.prefix("10.0.0.0/24")
+        self.prefix_v6 = self.data.prefix("2001:db8::/64")
+        self.prefix_v4.vlan = self.vlan1
+        self.prefix_v4.save()
+        self.data.prefix("10.9.0.0/24")
+
+    def test_each_dataset_fetched_once(self):
+        render_data = DeviceRenderData(self.device)
+        with self.assertNumQueries(3):
+            for _ in range(3):
+                self.assertEqual(len(render_data.ip_addresses), 2)
+                self.assertEqual(render_data.ip_addresses_v4.count(), 1)
+                self.assertEqual(len(render_data.ip_addresses_v6), 1)
+                self.assertEqual(len(render_data.prefixes), 2)
+                self.assertEqual(list(render_data.prefixes_v4), [self.prefix_v4])
+                self.assertEqual(list(render_data.prefixes_v6), [self.prefix_v6])
+                self.assertEqual(list(render_data.vlans), [self.vlan1])
+
+    def test_pickle(self):
+        render_data = pickle.loads(pickle.dumps(DeviceRenderData(self.device)))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(render_data.ip_addresses), 2)
+            self.assertEqual(list(render_data.prefixes_v6), [self.prefix_v6])
+            self.assertEqual(list(render_data.vlans), [self.vlan1])
+            self.assertEqual(render_data.config_context, {})
+
+    def test_chained_filter_uses_database(self):
+        render_data = DeviceRenderData(self.device)
+        list(render_data.prefixes)
+        self.assertEqual(
+            list(render_data.prefixes.filter(prefix__family=6)), [self.prefix_v6]
+        )
+
+
 class GetLoopbackCase(TestCaseMixin, TestCase):
     def test_has_loopback(self):
         device = self.data.device()
@@ -36,7 +137,7 @@ class GetLoopbackCase(TestCaseMixin, TestCase):
 
     def test_has_no_loopback(self):
         device = self.data.device()
-        ip_address_obj = self.data.ip_address("10.0.0.1")
+        self.data.ip_address("10.0.0.1")
         self.assertEqual(get_loopback(device), None)
 
 
@@ -59,6 +160,13 @@ class CombinePrefixesTestCase(TestCaseMixin, TestCase):
             [IPNetwork("10.0.0.0/23"), IPNetwork("10.0.5.0/24")],
         )
 
+    def test_queryset_not_loaded(self):
+        queryset = Prefix.objects.all()
+        with self.assertNumQueries(1):
+            combine_prefixes(queryset)
+        # Only the prefix column was fetched
+        self.assertIsNone(queryset._result_cache)
+
     def test_only_combined(self):
         self.assertEqual(
             combine_prefixes(
@@ -67,6 +175,63 @@ class CombinePrefixesTestCase(TestCaseMixin, TestCase):
             [IPNetwork("10.0.0.0/23")],
         )
 
+    def test_mixed_versions(self):
+        self.assertEqual(
+            combine_prefixes(
+                ["2001:db8::/33", "10.0.1.0/24", "2001:db8:8000::/33", self.prefix1]
+            ),
+            [IPNetwork("10.0.0.0/23"), IPNetwork("2001:db8::/32")],
+        )
+
+    def test_overlapping(self):
+        self.assertEqual(
+            combine_prefixes(["10.0.0.0/16", "10.0.5.0/24", "10.1.0.0/16"]),
+            [IPNetwork("10.0.0.0/15")],
+        )
+
+    def test_subtract(self):
+        self.assertEqual(
+            subtract_prefixes(["10.0.0.0/22"], [self.prefix2]),
+            [IPNetwork("10.0.0.0/24"), IPNetwork("10.0.2.0/23")],
+        )
+
+    def test_intersect(self):
+        self.assertEqual(
+            intersect_prefixes(Prefix.objects.all(), ["10.0.0.0/23", "10.0.4.0/22"]),
+            [IPNetwork("10.0.0.0/23"), IPNetwork("10.0.5.0/24")],
+        )
+
+    def test_supernets(self):
+        self.assertEqual(
+            supernet_prefixes(["10.0.0.8/29", "10.0.3.0/28", "10.0.0.0/8"], v4=24),
+            [IPNetwork("10.0.0.0/8")],
+        )
+        self.assertEqual(
+            supernet_prefixes(["10.0.0.8/29", "10.0.3.0/28"], v4=24),
+            [IPNetwork("10.0.0.0/24"), IPNetwork("10.0.3.0/24")],
+        )
+
+    def test_supernets_mixed_families(self):
+        prefixes = ["10.0.0.8/29", "2001:db8::/64", "2001:db8:0:1::/64"]
+        self.assertEqual(
+            supernet_prefixes(prefixes, v4=24),
+            [IPNetwork("10.0.0.0/24"), IPNetwork("2001:db8::/63"),],
+        )
+        self.assertEqual(
+            supernet_prefixes(prefixes, v4=24, v6=48),
+            [IPNetwork("10.0.0.0/24"), IPNetwork("2001:db8::/48")],
+        )
+
+    def test_loaded_queryset_not_queried_again(self):
+        device = self.data.device()
+        self.data.interface(device=device, ip_address=["10.0.0.1/24"])
+        render_data = DeviceRenderData(device)
+        render_data.rows("prefixes")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                combine_prefixes(render_data.prefixes), [IPNetwork("10.0.0.0/24")]
+            )
+
 
 class GetInterfaceTestCase(TestCaseMixin, TestCase):
     def setUp(self):
@@ -108,6 +273,150 @@ class GetInterfaceTestCase(TestCaseMixin, TestCase):
     def test_from_vlan(self):
         self.assertEqual(get_interface(self.device, self.vlan1), self.ether2)
 
+    def test_queries_once_per_render(self):
+        render_data = DeviceRenderData(self.device)
+        get_interface(self.device, "10.0.0.1", render_data=render_data)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_interface(self.device, "10.5.0.1", render_data=render_data),
+                self.ether2,
+            )
+            self.assertEqual(
+                get_interface(self.device, self.vlan1, render_data=render_data),
+                self.ether2,
+            )
+            self.assertIsNone(
+                get_interface(self.device, "192.168.0.1", render_data=render_data)
+            )
+
+    def test_most_specific_address(self):
+        ether3 = self.data.interface(device=self.device, ip_address=["10.5.0.2/28"])
+        self.assertEqual(get_interface(self.device, "10.5.0.0/24"), ether3)
+
+
+class GetPrefixTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        invalidate_prefix_index()
+        self.vrf = VRF.objects.create(name="Customer")
+        self.prefix8 = self.data.prefix("10.0.0.0/8")
+        self.prefix24 = self.data.prefix("10.5.0.0/24")
+        self.prefix28 = self.data.prefix("10.5.0.16/28")
+        self.vrf_prefix = self.data.prefix("10.5.0.0/16", vrf=self.vrf)
+
+    def test_most_specific(self):
+        self.assertEqual(get_prefix("10.5.0.1"), self.prefix24)
+        self.assertEqual(get_prefix("10.5.0.17/32"), self.prefix28)
+        self.assertEqual(get_prefix("10.6.0.1"), self.prefix8)
+
+    def test_network(self):
+        self.assertEqual(get_prefix("10.5.0.0/24"), self.prefix24)
+        self.assertEqual(get_prefix("10.5.0.0/23"), self.vrf_prefix)
+
+    def test_no_prefix(self):
+        self.assertIsNone(get_prefix("192.168.0.1"))
+        self.assertIsNone(get_prefix("2001:db8::1"))
+
+    def test_vrf(self):
+        self.assertEqual(get_prefix("10.5.1.1", vrf=self.vrf), self.vrf_prefix)
+        self.assertEqual(get_prefix("10.5.1.1", vrf_id=self.vrf.pk), self.vrf_prefix)
+        self.assertEqual(get_prefix("10.5.1.1", vrf=None), self.prefix8)
+        self.assertIsNone(get_prefix("10.6.0.1", vrf=self.vrf))
+
+    def test_extra_filters(self):
+        self.assertEqual(
+            get_prefix("10.5.0.1", prefix__net_mask_length__lte=16), self.vrf_prefix
+        )
+        self.assertEqual(
+            get_prefix("10.5.0.1", vrf=None, prefix__net_mask_length__lte=16),
+            self.prefix8,
+        )
+
+    def test_many(self):
+        self.assertEqual(
+            get_prefixes(["10.5.0.17", "192.168.0.1", "10.5.0.1"]),
+            [self.prefix28, None, self.prefix24],
+        )
+
+    def test_many_from_queryset(self):
+        self.data.ip_address("10.5.0.17/28")
+        self.data.ip_address("10.6.0.1/16")
+        self.assertEqual(
+            get_prefixes(IPAddressModel.objects.order_by("address")),
+            [self.prefix28, self.prefix8],
+        )
+
+    def test_queries_once_per_render(self):
+        device = self.data.device()
+        render_data = DeviceRenderData(device)
+        get_prefix("10.5.0.1", render_data=render_data)
+        with self.assertNumQueries(1):
+            # Loads the prefixes not yet seen
+            get_prefixes(["10.5.0.17", "10.6.0.1"], render_data=render_data)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_prefixes(["10.5.0.1", "10.5.0.17"], render_data=render_data),
+                [self.prefix24, self.prefix28],
+            )
+
+    def test_index_invalidated_on_change(self):
+        self.assertEqual(get_prefix("10.5.0.1"), self.prefix24)
+        prefix30 = self.data.prefix("10.5.0.0/30")
+        self.assertEqual(get_prefix("10.5.0.1"), prefix30)
+        prefix30.delete()
+        self.assertEqual(get_prefix("10.5.0.1"), self.prefix24)
+
+
+class GetAddressTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.data.device()
+        self.vlan1 = self.data.vlan()
+        self.vlan2 = self.data.vlan()
+        self.vlan3 = self.data.vlan()
+        self.data.prefix("10.0.0.0/24", vlan=self.vlan1)
+        self.data.prefix("10.5.0.0/16", vlan=self.vlan2)
+        self.data.prefix("192.168.0.0/24", vlan=self.vlan3)
+        self.ether1 = self.data.interface(
+            device=self.device, ip_address=["10.0.0.1/24", "10.5.0.1/24"]
+        )
+
+    def test_interface(self):
+        self.assertEqual(
+            str(get_address(self.device, self.ether1).address), "10.0.0.1/24"
+        )
+
+    def test_vlan(self):
+        self.assertEqual(
+            str(get_address(self.device, self.vlan1).address), "10.0.0.1/24"
+        )
+        self.assertEqual(
+            str(get_address(self.device, self.vlan2).address), "10.5.0.1/24"
+        )
+        self.assertIsNone(get_address(self.device, self.vlan3))
+
+    def test_vlan_with_filters(self):
+        self.assertEqual(
+            str(get_address(self.device, self.vlan2, status="active").address),
+            "10.5.0.1/24",
+        )
+
+    def test_queries_once_per_render(self):
+        render_data = DeviceRenderData(self.device)
+        get_address(self.device, self.vlan1, render_data=render_data)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                str(
+                    get_address(
+                        self.device, self.vlan2, render_data=render_data
+                    ).address
+                ),
+                "10.5.0.1/24",
+            )
+            self.assertIsNone(
+                get_address(self.device, self.vlan3, render_data=render_data)
+            )
+
 
 class GetVlanInterfaceTestCase(TestCaseMixin, TestCase):
     def setUp(self):
@@ -163,3 +472,349 @@ class GetVlanInterfaceTestCase(TestCaseMixin, TestCase):
 
         vlan = get_interface(self.device, "10.0.0.123", include_vlans=True)
         self.assertEqual(vlan, None)
+
+
+class GetTemplateTestCase(TestCaseMixin, TestCase):
+    def test_compiled_once_per_content(self):
+        template1 = get_template("test", "/ip address\nadd address={{ ip }}")
+        template2 = get_template("test", "/ip address\nadd address={{ ip }}")
+        template3 = get_template("test", "/ip address")
+        self.assertIs(template1, template2)
+        self.assertIsNot(template1, template3)
+        self.assertEqual(
+            template1.render(ip="10.0.0.1"), "/ip address\nadd address=10.0.0.1"
+        )
+
+    def test_loaded_template_invalidated_on_save(self):
+        configuration_template = self.data.configuration_template(
+            slug="included", content="one"
+        )
+        self.assertEqual(get_template("included").render(), "one")
+
+        # No need to check the database for changes
+        with self.assertNumQueries(0):
+            self.assertEqual(get_template("included").render(), "one")
+
+        configuration_template.content = "two"
+        configuration_template.save()
+        self.assertEqual(get_template("included").render(), "two")
+
+    def test_loaded_template_changed_by_another_process(self):
+        configuration_template = self.data.configuration_template(
+            slug="included", content="one"
+        )
+        device = self.data.device()
+        render = lambda: render_ros_config(
+            device,
+            template_name="test",
+            template_content="{% include 'included' %}",
+            context={},
+        )
+        self.assertEqual(render(), "one")
+
+        # Checked for changes once per render
+        with self.assertNumQueries(1):
+            self.assertEqual(render(), "one")
+
+        # Changed without the signal which would invalidate this process's
+        # cache, as if saved by another process
+        ConfigurationTemplate.objects.filter(pk=configuration_template.pk).update(
+            content="two", last_updated=now()
+        )
+        self.assertEqual(render(), "two")
+
+
+class LoadRenderDataTestCase(TestCaseMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.vlan1 = self.data.vlan()
+        self.device1 = self.data.device()
+        self.device2 = self.data.device()
+        self.data.interface(device=self.device1, ip_address=["10.0.0.1/24"])
+        self.data.interface(device=self.device2, ip_address=["10.0.1.1/24"])
+        self.data.interface(device=self.device2, ip_address=["2001:db8::1/64"])
+
+        self.data.prefix("10.0.0.0/8")
+        prefix = self.data.prefix("10.0.0.0/24")
+        prefix.vlan = self.vlan1
+        prefix.save()
+        self.data.prefix("10.0.1.0/24")
+        self.data.prefix("2001:db8::/64")
+        self.data.prefix("10.0.2.0/24")
+
+    def test_fixed_number_of_queries(self):
+        with CaptureQueriesContext(connection) as two_devices:
+            load_render_data([self.device1, self.device2])
+
+        devices = [self.device1, self.device2, self.data.device(), self.data.device()]
+        for device in devices[2:]:
+            self.data.interface(device=device, ip_address=[self.data.ip_address()])
+        with self.assertNumQueries(len(two_devices)):
+            load_render_data(devices)
+
+    def test_config_contexts(self):
+        ConfigContext.objects.create(name="a", weight=100, data={"a": 1, "b": 1})
+        ConfigContext.objects.create(name="b", weight=200, data={"b": 2})
+        self.device2.local_context_data = {"c": 3}
+        self.device2.save()
+
+        render_data = load_render_data([self.device1, self.device2])
+        self.assertEqual(render_data[self.device1.pk].config_context, {"a": 1, "b": 2})
+        self.assertEqual(
+            render_data[self.device2.pk].config_context, {"a": 1, "b": 2, "c": 3}
+        )
+        for device in (self.device1, self.device2):
+            self.assertEqual(
+                render_data[device.pk].config_context, device.get_config_context()
+            )
+
+    def test_matches_per_device_data(self):
+        render_data = load_render_data([self.device1, self.device2])
+        for device in (self.device1, self.device2):
+            expected = DeviceRenderData(device)
+            actual = render_data[device.pk]
+            for name in ("ip_addresses", "prefixes", "prefixes_v6", "vlans"):
+                self.assertEqual(
+                    list(getattr(actual, name)), list(getattr(expected, name))
+                )
+            for name in ("interfaces", "addresses", "tagged_vlans"):
+                self.assertEqual(
+                    getattr(actual.interface_index, name),
+                    getattr(expected.interface_index, name),
+                )
+
+        self.assertEqual(len(render_data[self.device1.pk].prefixes), 2)
+        self.assertEqual(len(render_data[self.device2.pk].prefixes), 3)
+        self.assertEqual(list(render_data[self.device1.pk].vlans), [self.vlan1])
+        self.assertEqual(list(render_data[self.device2.pk].vlans), [])
+
+    def test_duplicate_prefixes(self):
+        # The same network in two VRFs, each with its own VLAN
+        vlan2 = self.data.vlan()
+        vlan3 = self.data.vlan()
+        for vlan in (vlan2, vlan3):
+            vrf = VRF.objects.create(name=f"VRF {vlan.vid}")
+            self.data.prefix("10.0.1.0/25", vrf=vrf, vlan=vlan)
+
+        render_data = load_render_data([self.device1, self.device2])
+        for device in (self.device1, self.device2):
+            expected = DeviceRenderData(device)
+            actual = render_data[device.pk]
+            for name in ("prefixes", "vlans"):
+                self.assertEqual(
+                    list(getattr(actual, name)), list(getattr(expected, name))
+                )
+
+        self.assertEqual(len(render_data[self.device2.pk].prefixes), 5)
+        self.assertEqual(
+            set(render_data[self.device2.pk].vlans), {vlan2, vlan3},
+        )
+
+
+class RenderRosConfigManyTestCase(TestCaseMixin, TestCase):
+    def test_render(self):
+        device1 = self.data.device()
+        device2 = self.data.device()
+        self.data.interface(device=device1, ip_address=["10.0.0.1/24"])
+        self.data.interface(device=device2, ip_address=["10.0.1.1/24"])
+
+        results = render_ros_config_many(
+            [device1, device2],
+            template_name="test",
+            template_content="{% for ip in ip_addresses %}{{ ip.address }}{% endfor %}",
+        )
+        self.assertEqual([r.device for r in results], [device1, device2])
+        self.assertEqual([r.config for r in results], ["10.0.0.1/24", "10.0.1.1/24"])
+        self.assertEqual([r.error for r in results], [None, None])
+
+    def test_fixed_number_of_queries(self):
+        vlan = self.data.vlan()
+        self.data.prefix("10.0.0.0/8", vlan=vlan)
+        devices = []
+        for i in range(4):
+            device = self.data.device()
+            interface = self.data.interface(device=device, ip_address=f"10.0.{i}.1/24")
+            interface.tagged_vlans.add(vlan)
+            devices.append(device)
+
+        def render(devices):
+            with CaptureQueriesContext(connection) as queries:
+                results = render_ros_config_many(
+                    devices,
+                    template_name="test",
+                    template_content=(
+                        "{% for ip in ip_addresses %}"
+                        "{{ get_interface(ip.address) }}"
+                        "{{ get_interface(ip.address, include_vlans=False) }}"
+                        "{% endfor %}"
+                        "{% for vlan in vlans %}{{ get_interface(vlan) }}{% endfor %}"
+                    ),
+                )
+            self.assertEqual([r.error for r in results], [None] * len(devices))
+            # Each render checks whether the templates have changed, which
+            # is the only query made per device
+            return [
+                q["sql"]
+                for q in queries.captured_queries
+                if "netbox_routeros_configurationtemplate" not in q["sql"]
+            ]
+
+        self.assertEqual(len(render(devices)), len(render(devices[:2])))
+
+    def test_error(self):
+        device = self.data.device()
+        results = render_ros_config_many(
+            [device], template_name="test", template_content="{{ 1 / 0 }}",
+        )
+        self.assertIsNone(results[0].config)
+        self.assertIn("ZeroDivisionError", results[0].error)
+
+
+class RenderRosConfigParallelTestCase(TestCaseMixin, TestCase):
+    def test_render_in_process(self):
+        device = self.data.device()
+        self.data.interface(device=device, ip_address=["10.0.0.1/24"])
+
+        results = render_ros_config_parallel(
+            [device],
+            template_name="test",
+            template_content=(
+                "/ip address\n"
+                "{% for ip in ip_addresses %}add address={{ ip.address }}{% endfor %}"
+            ),
+            processes=1,
+        )
+        self.assertEqual(results[0].error, None)
+        self.assertEqual(results[0].config, "/ip address\nadd address=10.0.0.1/24")
+        self.assertEqual(results[0].parsed.keys(), ["/ip address"])
+
+
+class RenderRosConfigParallelProcessesTestCase(TestCaseMixin, TransactionTestCase):
+    def test_render_in_processes(self):
+        vlan = self.data.vlan()
+        devices = [self.data.device(), self.data.device(), self.data.device()]
+        for i, device in enumerate(devices):
+            self.data.interface(device=device, ip_address=[f"10.0.{i}.1/24"])
+
+        results = render_ros_config_parallel(
+            devices,
+            template_name="test",
+            template_content=(
+                "/ip address\n"
+                "{% for ip in ip_addresses %}add address={{ ip.address }}{% endfor %}\n"
+                # Queries the database from within the worker
+                "/system identity\nset name={{ VLAN.objects.get().name }}"
+            ),
+            processes=2,
+        )
+        self.assertEqual([r.error for r in results], [None, None, None])
+        self.assertEqual(
+            [r.config for r in results],
+            [
+                f"/ip address\nadd address=10.0.{i}.1/24\n"
+                f"/system identity\nset name={vlan.name}"
+                for i in range(3)
+            ],
+        )
+
+    def test_in_transaction_renders_in_process(self):
+        devices = [self.data.device(), self.data.device()]
+        with transaction.atomic():
+            self.data.vlan(name="uncommitted")
+            results = render_ros_config_parallel(
+                devices,
+                template_name="test",
+                template_content="{{ VLAN.objects.get().name }}",
+                processes=2,
+            )
+            # The transaction is still usable
+            self.assertEqual(VLAN.objects.count(), 1)
+        self.assertEqual([r.config for r in results], ["uncommitted", "uncommitted"])
+
+
+class RenderRecorderTestCase(TestCaseMixin, TestCase):
+    def test_recorded(self):
+        device = self.data.device()
+        interface = self.data.interface(device=device, ip_address="10.0.0.1/24")
+        prefix = self.data.prefix("10.0.0.0/24")
+        render_data = DeviceRenderData(device)
+        recorder = RenderRecorder(render_data)
+
+        render_ros_config(
+            device,
+            template_name="test",
+            template_content=(
+                "{{ device.name }}{% for ip in ip_addresses %}{{ ip }}{% endfor %}"
+                "{{ get_prefix('10.0.0.1') }}{{ VLAN.objects.count() }}"
+            ),
+            render_data=render_data,
+            recorder=recorder,
+        )
+
+        dependencies = recorder.as_dict()
+        self.assertEqual(dependencies["models"], ["ipam.vlan"])
+        self.assertEqual(dependencies["functions"], {"get_prefix": 1})
+        self.assertEqual(dependencies["objects"]["dcim.device"], [device.pk])
+        self.assertEqual(dependencies["objects"]["dcim.interface"], [interface.pk])
+        self.assertEqual(dependencies["objects"]["ipam.prefix"], [prefix.pk])
+        self.assertEqual(len(dependencies["objects"]["ipam.ipaddress"]), 1)
+
+    def test_attributes_recorded(self):
+        device = self.data.device()
+        self.data.interface(device=device, ip_address="10.0.0.1/24")
+        vlan = self.data.vlan()
+        self.data.prefix("10.0.0.0/24", vlan=vlan)
+        render_data = DeviceRenderData(device)
+        recorder = RenderRecorder(render_data)
+
+        render_ros_config(
+            device,
+            template_name="test",
+            template_content=(
+                "{% for prefix in prefixes %}{{ prefix.vlan.vid }}{% endfor %}"
+                "{{ device['site'] }}"
+            ),
+            render_data=render_data,
+            recorder=recorder,
+        )
+
+        dependencies = recorder.as_dict()
+        self.assertEqual(dependencies["objects"]["ipam.vlan"], [vlan.pk])
+        self.assertEqual(dependencies["objects"]["dcim.site"], [device.site_id])
+
+
+class RenderProfilerTestCase(TestCaseMixin, TestCase):
+    def test_profiled(self):
+        device = self.data.device()
+        self.data.interface(device=device, ip_address="10.0.0.1/24")
+        profiler = RenderProfiler()
+
+        render_ros_config(
+            device,
+            template_name="test",
+            template_content=(
+                "{% for ip in ip_addresses %}{{ ip }}{% endfor %}"
+                "{{ get_prefix('10.0.0.1') }}{{ get_prefix('10.0.0.1') }}"
+                "{{ VLAN.objects.count() }}{{ VLAN.objects.count() }}"
+            ),
+            extra_config="/system identity",
+            profiler=profiler,
+        )
+
+        profile = profiler.as_dict()
+        self.assertEqual(
+            {stage for stage, _ in profile["stages"]},
+            {
+                "compile template",
+                "create context",
+                "render template",
+                "render extra configuration",
+            },
+        )
+        self.assertEqual(profiler.functions["get_prefix"].calls, 2)
+        # The prefix index is only checked once per render, so the only
+        # duplicate is the template's own query
+        self.assertEqual(len(profile["duplicate_queries"]), 1)
+        self.assertIn("ipam_vlan", profile["duplicate_queries"][0][0])
+        self.assertEqual(profile["duplicate_queries"][0][1], 2)
+        self.assertGreaterEqual(profile["query_count"], 3)
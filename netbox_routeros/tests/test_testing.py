@@ -0,0 +1,49 @@
+from dcim.models import Device
+from netbox_routeros.models import ConfiguredDevice
+from netbox_routeros.testing import TestCaseMixin
+from utilities.testing import TestCase
+
+
+class FleetTestCase(TestCaseMixin, TestCase):
+    def test_fleet(self):
+        configuration_template = self.data.configuration_template()
+        # Create the defaults up front, so we only count the fleet's queries
+        self.data.any_device()
+
+        with self.assertNumQueries(9):
+            fleet = self.data.fleet(
+                devices=3,
+                interfaces=4,
+                prefixes=2,
+                vlans=1,
+                configuration_template=configuration_template,
+            )
+
+        self.assertEqual(len(fleet.devices), 3)
+        self.assertEqual(len(fleet.interfaces), 12)
+        self.assertEqual(len(fleet.ip_addresses), 12)
+        self.assertEqual(len(fleet.prefixes), 6)
+        self.assertEqual([vlan.vid for vlan in fleet.vlans], [2, 3, 4])
+        self.assertEqual(ConfiguredDevice.objects.count(), 3)
+
+        device = fleet.devices[2]
+        self.assertEqual(device.name, "device-2")
+        self.assertEqual(
+            [str(ip.address) for ip in fleet.ip_addresses[8:]],
+            ["10.0.2.1/30", "10.0.2.5/30", "10.0.2.9/30", "10.0.2.13/30"],
+        )
+        self.assertEqual(
+            [
+                str(ip.address)
+                for ip in device.interfaces.get(name="ether2").ip_addresses.all()
+            ],
+            ["10.0.2.5/30"],
+        )
+        self.assertEqual(str(fleet.prefixes[4].prefix), "10.0.2.0/30")
+        self.assertEqual(fleet.prefixes[4].vlan, fleet.vlans[2])
+        self.assertIsNone(fleet.prefixes[5].vlan)
+
+    def test_too_many_vlans(self):
+        with self.assertRaisesRegex(ValueError, "4094"):
+            self.data.fleet(devices=2100, interfaces=2, prefixes=2, vlans=2)
+        self.assertEqual(Device.objects.count(), 0)
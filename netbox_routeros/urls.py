@@ -53,6 +53,13 @@ urlpatterns = [
         views.PushConfigView.as_view(),
         name="configureddevice_push_config",
     ),
+    path(
+        "configured-device/check-drift/",
+        views.CheckDriftView.as_view(),
+        name="configureddevice_check_drift",
+    ),
+    # Config jobs
+    path("config-jobs/<int:pk>/", views.ConfigJobView.as_view(), name="configjob",),
     # Configuration templates
     path(
         "configuration-templates/",
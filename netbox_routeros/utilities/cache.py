@@ -0,0 +1,30 @@
+import hashlib
+import json
+from typing import Any, Callable
+
+from django.core.cache import cache
+
+from netbox_routeros.utilities.settings import get_plugin_setting
+
+
+def fingerprint(data) -> str:
+    """Get a hash of the given JSON-compatible data"""
+    serialised = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode("utf8")).hexdigest()
+
+
+def get_or_compute(key_data, compute: Callable[[], Any], timeout: int = None):
+    """Get a value from Django's cache, computing and storing it if missing
+
+    The cache key is a fingerprint of key_data, so key_data should include
+    everything which the value depends upon.
+    """
+    if timeout is None:
+        timeout = get_plugin_setting("render_cache_timeout")
+
+    key = f"netbox_routeros:{fingerprint(key_data)}"
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
@@ -1,18 +1,26 @@
-from typing import TYPE_CHECKING
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Optional
 
 from django.conf import settings
 
 from netbox.api.exceptions import ServiceUnavailable
+from netbox_routeros.utilities.settings import get_plugin_setting
 
 if TYPE_CHECKING:
     from dcim.models import Device
 
+logger = logging.getLogger(__name__)
+
 
 def get_napalm_driver(device: "Device"):
     # Credit: Code pulled from netbox core
     # Check that NAPALM is installed
     try:
-        import napalm
         from napalm.base.exceptions import ModuleImportError
     except ModuleNotFoundError as e:
         if getattr(e, "name") == "napalm":
@@ -23,7 +31,7 @@ def get_napalm_driver(device: "Device"):
 
     # Validate the configured driver
     try:
-        driver = napalm.get_network_driver(device.platform.napalm_driver)
+        driver = _get_driver_class(device.platform.napalm_driver)
     except ModuleImportError:
         raise ServiceUnavailable(
             "NAPALM driver for platform {} not found: {}.".format(
@@ -31,23 +39,182 @@ def get_napalm_driver(device: "Device"):
             )
         )
 
-    host = str(device.primary_ip.address.ip)
-    username = settings.NAPALM_USERNAME
-    password = settings.NAPALM_PASSWORD
+    d = driver(**_get_connection_args(device))
+
+    # Note that we don't open the connection here. Use napalm_session()
+    # when several operations should share a single connection
+
+    return d
+
+
+@lru_cache(maxsize=None)
+def _get_driver_class(name: str):
+    import napalm
+
+    return napalm.get_network_driver(name)
+
+
+def _get_connection_args(device: "Device") -> dict:
     optional_args = settings.NAPALM_ARGS.copy()
     if device.platform.napalm_args is not None:
         optional_args.update(device.platform.napalm_args)
 
-    # Connect to the device
-    d = driver(
-        hostname=host,
-        username=username,
-        password=password,
+    return dict(
+        hostname=str(device.primary_ip.address.ip),
+        username=settings.NAPALM_USERNAME,
+        password=settings.NAPALM_PASSWORD,
         timeout=settings.NAPALM_TIMEOUT,
         optional_args=optional_args,
     )
 
-    # Note that we don't open the connection as
-    # we do not require API access
 
-    return d
+class _PooledConnection:
+    def __init__(self, key: str):
+        # Identifies the settings the connection was made with, so we can
+        # tell if they have since changed
+        self.key = key
+        self.driver = None
+        # Whether driver.open() has been called
+        self.opened = False
+        # Only one thread may use a connection at a time
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+class NapalmDriverPool:
+    """Keeps NAPALM connections open so they can be reused
+
+    Connections are keyed by device. A connection is checked to be alive
+    before it is handed out, and is closed once it has been idle for longer
+    than idle_timeout seconds.
+
+    Drivers are only opened if open_sessions is set (see the
+    napalm_open_sessions setting). Otherwise each operation connects as it
+    needs to, which does not require the RouterOS API service.
+    """
+
+    def __init__(
+        self, idle_timeout: Optional[float] = None, open_sessions: bool = None
+    ):
+        self._idle_timeout = idle_timeout
+        self._open_sessions = open_sessions
+        self._lock = threading.Lock()
+        self._connections: Dict[int, _PooledConnection] = {}
+
+    @property
+    def idle_timeout(self) -> float:
+        if self._idle_timeout is None:
+            return get_plugin_setting("napalm_pool_idle_timeout")
+        return self._idle_timeout
+
+    @property
+    def open_sessions(self) -> bool:
+        if self._open_sessions is None:
+            return get_plugin_setting("napalm_open_sessions")
+        return self._open_sessions
+
+    @contextmanager
+    def connection(self, device: "Device"):
+        """Get a connected driver for the device, for use within the block"""
+        self.evict_idle()
+
+        key = repr(sorted(_get_connection_args(device).items()))
+        with self._lock:
+            pooled = self._connections.get(device.pk)
+            if pooled is None or pooled.key != key:
+                if pooled is not None and pooled.lock.acquire(blocking=False):
+                    # Close the outdated connection, unless it is in use, in
+                    # which case its current user will close it
+                    self._close(pooled)
+                    pooled.lock.release()
+                pooled = _PooledConnection(key)
+                self._connections[device.pk] = pooled
+
+        with pooled.lock:
+            try:
+                if pooled.driver is None or (
+                    pooled.opened and not self._is_alive(pooled.driver)
+                ):
+                    self._close(pooled)
+                    pooled.driver = get_napalm_driver(device)
+                    if self.open_sessions:
+                        pooled.driver.open()
+                        pooled.opened = True
+                yield pooled.driver
+            except Exception:
+                # We cannot be sure what state the session is in now
+                self._discard(device.pk, pooled)
+                raise
+            finally:
+                pooled.last_used = time.monotonic()
+
+        with self._lock:
+            replaced = self._connections.get(device.pk) is not pooled
+        if replaced or not self.idle_timeout:
+            # Either pooling is disabled, or the device's settings changed
+            # while we were using the connection
+            self._discard(device.pk, pooled)
+
+    def evict_idle(self):
+        """Close any connections which have not been used recently"""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            items = list(self._connections.items())
+        for pk, pooled in items:
+            if pooled.last_used < cutoff and pooled.lock.acquire(blocking=False):
+                try:
+                    self._discard(pk, pooled)
+                finally:
+                    pooled.lock.release()
+
+    def close_all(self):
+        with self._lock:
+            items = list(self._connections.items())
+        for pk, pooled in items:
+            self._discard(pk, pooled)
+
+    def _discard(self, pk: int, pooled: _PooledConnection):
+        with self._lock:
+            if self._connections.get(pk) is pooled:
+                del self._connections[pk]
+        self._close(pooled)
+
+    def _close(self, pooled: _PooledConnection):
+        driver, pooled.driver = pooled.driver, None
+        opened, pooled.opened = pooled.opened, False
+        if driver is not None and opened:
+            try:
+                driver.close()
+            except Exception:
+                logger.debug("Error closing NAPALM connection", exc_info=True)
+
+    def _is_alive(self, driver) -> bool:
+        try:
+            return driver.is_alive()["is_alive"]
+        except NotImplementedError:
+            # The driver cannot tell us, so assume all is well
+            return True
+        except Exception:
+            return False
+
+
+driver_pool = NapalmDriverPool()
+atexit.register(driver_pool.close_all)
+
+
+@contextmanager
+def napalm_session(device: "Device"):
+    """Get a NAPALM driver for use for the duration of the block
+
+    If the napalm_open_sessions setting is enabled, the driver is connected,
+    and every operation performed on it within the block shares the one
+    authenticated session, rather than each connecting separately. With
+    napalm-ros this requires the RouterOS API service. The session is taken
+    from (and returned to) the connection pool, so consecutive blocks for
+    the same device will also share a session.
+
+    Otherwise, as before, the driver is not opened, and each operation
+    connects as it needs to.
+    """
+    with driver_pool.connection(device) as driver:
+        yield driver
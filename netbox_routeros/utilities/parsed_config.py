@@ -0,0 +1,81 @@
+"""Storage of parsed configs, so they need not be parsed each time they are used
+
+Parsed configs are stored as pickles, as rebuilding one from any simpler
+form costs much the same as parsing the text again. Unpickling untrusted
+data can run arbitrary code, so each stored config is signed using the
+SECRET_KEY, and is only unpickled if its signature is valid. Someone able
+to write to the database therefore cannot run code in the web process
+unless they also know the SECRET_KEY.
+"""
+import hashlib
+import hmac
+import pickle
+import zlib
+from importlib import metadata
+from typing import Optional
+
+from django.utils.crypto import salted_hmac
+from routeros_diff import RouterOSConfig
+
+# Bump this if the way we store parsed configs changes. Stored configs
+# from a different version are ignored and the text is parsed again
+FORMAT_VERSION = 2
+
+SIGNATURE_SALT = "netbox_routeros.parsed_config"
+
+
+def get_parser_version() -> str:
+    """Identifies the parser which produced a stored config
+
+    routeros_diff's own __version__ is not kept up to date, so use the
+    version of the installed package instead.
+    """
+    try:
+        routeros_diff_version = metadata.version("routeros_diff")
+    except metadata.PackageNotFoundError:
+        routeros_diff_version = "unknown"
+    return f"{routeros_diff_version}:{FORMAT_VERSION}"
+
+
+PARSER_VERSION = get_parser_version()
+
+
+def dump_config(text: str, config: RouterOSConfig) -> bytes:
+    """Serialise the parsed version of text into a compact form for storage
+
+    The result is prefixed with a key identifying both the parser version
+    and the text which was parsed, so that load_config() can tell if it has
+    become outdated, and with a signature of the key & data.
+    """
+    key = _key(text)
+    data = zlib.compress(pickle.dumps(config, protocol=pickle.HIGHEST_PROTOCOL))
+    return key + b"\n" + _sign(key, data) + b"\n" + data
+
+
+def load_config(data: Optional[bytes], text: str) -> Optional[RouterOSConfig]:
+    """Load the parsed version of text which was stored by dump_config()
+
+    Returns None if the stored config was parsed from different text, by a
+    different parser version, is not correctly signed, or cannot be loaded.
+    The text should be parsed again in this case.
+    """
+    if not data:
+        return None
+    key, _, data = bytes(data).partition(b"\n")
+    signature, _, data = data.partition(b"\n")
+    if key != _key(text) or not hmac.compare_digest(signature, _sign(key, data)):
+        return None
+    try:
+        return pickle.loads(zlib.decompress(data))
+    except Exception:
+        return None
+
+
+def _key(text: str) -> bytes:
+    digest = hashlib.sha256(text.encode("utf8")).hexdigest()
+    return f"{PARSER_VERSION}:{digest}".encode("ascii")
+
+
+def _sign(key: bytes, data: bytes) -> bytes:
+    signature = salted_hmac(SIGNATURE_SALT, key + b"\n" + data, algorithm="sha256")
+    return signature.hexdigest().encode("ascii")
@@ -0,0 +1,209 @@
+"""Set operations on prefixes, for use in templates
+
+Prefixes are handled as ranges of integers, one list of ranges per IP
+version. Ranges are merged & compared numerically, and are only turned back
+into networks at the end. This avoids creating an object for every input
+prefix, which matters when aggregating thousands of prefixes.
+"""
+from collections import defaultdict
+from ipaddress import IPv4Network, IPv6Network
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import netaddr
+from django.db.models import QuerySet
+
+from ipam.models import IPAddress, Prefix
+from netbox_routeros.render_data import is_loaded
+
+# The first & last addresses in a range, inclusive
+Range = Tuple[int, int]
+
+WIDTHS = {4: 32, 6: 128}
+
+# Rows fetched at a time when streaming networks from a queryset
+QUERYSET_CHUNK_SIZE = 2000
+
+
+def combine(prefixes: Iterable, only_combined=False) -> List[netaddr.IPNetwork]:
+    """Combine prefixes into the fewest networks which cover the same addresses
+
+    If only_combined is set then networks which were given as-is are
+    excluded, leaving only those created by combining.
+    """
+    parsed = parse_prefixes(prefixes)
+    if only_combined:
+        parsed = list(parsed)
+    networks = to_networks(merge_ranges(_ranges(parsed)))
+    if only_combined:
+        given = set(parsed)
+        networks = [
+            n for n in networks if (n.version, n.first, n.prefixlen) not in given
+        ]
+    return networks
+
+
+def subtract(prefixes: Iterable, excluded: Iterable) -> List[netaddr.IPNetwork]:
+    """Get the networks covering the prefixes, less those covered by excluded"""
+    ranges = merge_ranges(_ranges(parse_prefixes(prefixes)))
+    excluded_ranges = merge_ranges(_ranges(parse_prefixes(excluded)))
+    return to_networks(
+        {
+            version: _subtract_ranges(version_ranges, excluded_ranges.get(version, []))
+            for version, version_ranges in ranges.items()
+        }
+    )
+
+
+def intersect(prefixes: Iterable, other: Iterable) -> List[netaddr.IPNetwork]:
+    """Get the networks covering the addresses in both prefixes and other"""
+    ranges = merge_ranges(_ranges(parse_prefixes(prefixes)))
+    other_ranges = merge_ranges(_ranges(parse_prefixes(other)))
+    return to_networks(
+        {
+            version: _intersect_ranges(version_ranges, other_ranges.get(version, []))
+            for version, version_ranges in ranges.items()
+        }
+    )
+
+
+def supernets(
+    prefixes: Iterable, v4: int = None, v6: int = None
+) -> List[netaddr.IPNetwork]:
+    """Widen each prefix to the given length for its family, then combine them
+
+    Prefixes which are already shorter than the length are left as they are,
+    as are those of a family with no length given.
+    """
+    prefixlens = {4: v4, 6: v6}
+    ranges = defaultdict(list)
+    for version, first, length in parse_prefixes(prefixes):
+        width = WIDTHS[version]
+        if prefixlens[version] is not None:
+            length = min(length, prefixlens[version])
+        host_bits = width - length
+        first = first >> host_bits << host_bits
+        ranges[version].append((first, first + (1 << host_bits) - 1))
+    return to_networks(merge_ranges(ranges))
+
+
+def iter_networks(items: Iterable) -> Iterable:
+    """Iterate over prefixes/addresses, avoiding model instances for querysets
+
+    Querysets which have not yet been loaded have only their network column
+    fetched, in chunks, so large tables are not held in memory at once.
+    Anything else is returned as-is.
+    """
+    if isinstance(items, QuerySet) and not is_loaded(items):
+        field = "address" if items.model is IPAddress else "prefix"
+        return items.values_list(field, flat=True).iterator(
+            chunk_size=QUERYSET_CHUNK_SIZE
+        )
+    return items
+
+
+def to_network(item) -> netaddr.IPNetwork:
+    """Get the network for a Prefix, IPAddress, string, or network"""
+    if isinstance(item, Prefix):
+        item = item.prefix
+    elif isinstance(item, IPAddress):
+        item = item.address
+    if isinstance(item, netaddr.IPNetwork):
+        return item
+    return netaddr.IPNetwork(str(item))
+
+
+def parse_prefixes(prefixes: Iterable) -> Iterator[Tuple[int, int, int]]:
+    """Get the IP version, first address & prefix length of each prefix
+
+    Accepts anything iter_networks() & to_network() do.
+    """
+    for prefix in iter_networks(prefixes):
+        if isinstance(prefix, (IPv4Network, IPv6Network)):
+            yield prefix.version, int(prefix.network_address), prefix.prefixlen
+        else:
+            prefix = to_network(prefix)
+            yield prefix.version, prefix.first, prefix.prefixlen
+
+
+def merge_ranges(ranges: Dict[int, List[Range]]) -> Dict[int, List[Range]]:
+    """Sort each version's ranges, merging any which overlap or are adjacent"""
+    merged = {}
+    for version, version_ranges in ranges.items():
+        out = []
+        for first, last in sorted(version_ranges):
+            if out and first <= out[-1][1] + 1:
+                if last > out[-1][1]:
+                    out[-1] = (out[-1][0], last)
+            else:
+                out.append((first, last))
+        merged[version] = out
+    return merged
+
+
+def to_networks(ranges: Dict[int, List[Range]]) -> List[netaddr.IPNetwork]:
+    """Get the fewest networks which exactly cover the ranges
+
+    IPv4 networks come first, then IPv6.
+    """
+    networks = []
+    for version in sorted(ranges):
+        width = WIDTHS[version]
+        for first, last in ranges[version]:
+            networks.extend(
+                netaddr.IPNetwork((value, prefixlen), version=version)
+                for value, prefixlen in _range_to_cidrs(first, last, width)
+            )
+    return networks
+
+
+def _ranges(parsed: Iterable[Tuple[int, int, int]]) -> Dict[int, List[Range]]:
+    ranges = defaultdict(list)
+    for version, first, prefixlen in parsed:
+        host_bits = WIDTHS[version] - prefixlen
+        first = first >> host_bits << host_bits
+        ranges[version].append((first, first + (1 << host_bits) - 1))
+    return ranges
+
+
+def _range_to_cidrs(first: int, last: int, width: int) -> Iterator[Tuple[int, int]]:
+    """Split a range into the fewest aligned blocks, as (first, prefix length)"""
+    while first <= last:
+        # The largest block which starts at first, and which fits in the range
+        alignment = (first & -first).bit_length() - 1 if first else width
+        host_bits = min(alignment, (last - first + 1).bit_length() - 1)
+        yield first, width - host_bits
+        first += 1 << host_bits
+
+
+def _subtract_ranges(ranges: List[Range], excluded: List[Range]) -> List[Range]:
+    """Subtract one sorted, merged list of ranges from another"""
+    out = []
+    i = 0
+    for first, last in ranges:
+        while i < len(excluded) and excluded[i][1] < first:
+            i += 1
+        j = i
+        while j < len(excluded) and excluded[j][0] <= last:
+            if excluded[j][0] > first:
+                out.append((first, excluded[j][0] - 1))
+            first = max(first, excluded[j][1] + 1)
+            j += 1
+        if first <= last:
+            out.append((first, last))
+    return out
+
+
+def _intersect_ranges(ranges: List[Range], other: List[Range]) -> List[Range]:
+    """Intersect two sorted, merged lists of ranges"""
+    out = []
+    i = j = 0
+    while i < len(ranges) and j < len(other):
+        first = max(ranges[i][0], other[j][0])
+        last = min(ranges[i][1], other[j][1])
+        if first <= last:
+            out.append((first, last))
+        if ranges[i][1] < other[j][1]:
+            i += 1
+        else:
+            j += 1
+    return out
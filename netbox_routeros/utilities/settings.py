@@ -0,0 +1,10 @@
+from django.conf import settings
+
+
+def get_plugin_setting(name: str):
+    """Get a setting for this plugin, as set in PLUGINS_CONFIG
+
+    Netbox populates PLUGINS_CONFIG with the plugin's default_settings,
+    so every setting listed there will always be present.
+    """
+    return settings.PLUGINS_CONFIG["netbox_routeros"][name]
@@ -7,21 +7,29 @@ from django.db.models import Model
 from django.http import HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import render
 from django.views import View
-from jinja2 import TemplateError, TemplateNotFound
-from napalm.base.exceptions import CommandErrorException
-from paramiko import AuthenticationException
+from jinja2 import TemplateNotFound
 
 from dcim.models import Device
 from routeros_diff import RouterOSConfig
 from netbox.views import generic
-from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice
+from netbox_routeros.models import ConfigurationTemplate, ConfiguredDevice, ConfigJob
 from pprint import pformat
 
 from utilities.views import GetReturnURLMixin
 from . import filters
 from . import forms
 from . import tables
-from .ros_config_maker import render_ros_config, make_ros_config_context
+from .jobs import create_config_job, fail_stuck_jobs
+from .render_data import DeviceRenderData
+from .render_profiler import RenderProfiler, profile_stage
+from .ros_config_maker import (
+    get_template_source,
+    get_templates_version,
+    render_ros_config,
+    make_ros_config_context,
+    template_models,
+)
+from .utilities.cache import get_or_compute
 
 
 class ConfiguredDeviceListView(generic.ObjectListView):
@@ -29,7 +37,7 @@ class ConfiguredDeviceListView(generic.ObjectListView):
         "device", "configuration_template"
     ).all()
     filterset = filters.ConfiguredDeviceFilterSet
-    filterset_form = forms.ConfiguredDeviceForm
+    filterset_form = forms.ConfiguredDeviceFilterForm
     table = tables.ConfiguredDeviceTable
     template_name = "routeros/configured_device_list.html"
     action_buttons = []
@@ -51,15 +59,10 @@ class PullConfigView(GetReturnURLMixin, View):
 
         pks = request.POST.getlist("pk")
         objs = ConfiguredDevice.objects.filter(pk__in=pks)
-        for configured_device in objs:
-            if not configured_device.problems:
-                try:
-                    configured_device.fetch_config()
-                except AuthenticationException as e:
-                    messages.error(request, str(e))
+        job = create_config_job(ConfigJob.KIND_FETCH, objs, user=request.user)
 
-        messages.success(request, f"Fetched {len(pks)} device configurations")
-        return HttpResponseRedirect(self.get_return_url(request))
+        messages.info(request, f"Fetching {len(pks)} device configurations")
+        return HttpResponseRedirect(job.get_absolute_url())
 
 
 class PushConfigView(GetReturnURLMixin, View):
@@ -70,24 +73,44 @@ class PushConfigView(GetReturnURLMixin, View):
 
         pks = request.POST.getlist("pk")
         objs = ConfiguredDevice.objects.filter(pk__in=pks)
+        job = create_config_job(ConfigJob.KIND_PUSH, objs, user=request.user)
 
-        successes = 0
-        for configured_device in objs:
-            if not configured_device.problems:
-                try:
-                    configured_device.push_config()
-                except CommandErrorException as e:
-                    messages.error(request, str(e))
-                else:
-                    successes += 1
-
-        message = f"Pushed {successes} device configuration(s)"
-        if successes:
-            messages.success(request, message)
-        else:
-            messages.warning(request, message)
+        messages.info(request, f"Pushing {len(pks)} device configuration(s)")
+        return HttpResponseRedirect(job.get_absolute_url())
+
+
+class CheckDriftView(GetReturnURLMixin, View):
+    def post(self, request):
+        # Verify user permission
+        if not request.user.has_perm("netbox_routeros.change_configureddevice"):
+            return HttpResponseForbidden()
 
-        return HttpResponseRedirect(self.get_return_url(request))
+        pks = request.POST.getlist("pk")
+        objs = ConfiguredDevice.objects.filter(pk__in=pks)
+        job = create_config_job(ConfigJob.KIND_DRIFT, objs, user=request.user)
+
+        messages.info(request, f"Checking drift for {len(pks)} device(s)")
+        return HttpResponseRedirect(job.get_absolute_url())
+
+
+class ConfigJobView(generic.ObjectView):
+    queryset = ConfigJob.objects.all()
+    template_name = "routeros/config_job.html"
+
+    def get_extra_context(self, request, instance: ConfigJob):
+        if fail_stuck_jobs(ConfigJob.objects.filter(pk=instance.pk)):
+            instance.refresh_from_db()
+        job_devices = instance.devices.select_related("configured_device__device")
+        status_counts = {}
+        for job_device in job_devices:
+            status_counts[job_device.status] = (
+                status_counts.get(job_device.status, 0) + 1
+            )
+
+        return {
+            "job_devices": job_devices,
+            "status_counts": sorted(status_counts.items()),
+        }
 
 
 class ConfiguredDeviceView(generic.ObjectView):
@@ -95,28 +118,54 @@ class ConfiguredDeviceView(generic.ObjectView):
     template_name = "routeros/configured_device.html"
 
     def get_extra_context(self, request, instance: ConfiguredDevice):
+        # Shared by everything rendered for this page, so the device's data
+        # is only loaded (and its template context only built) once. Rendered
+        # output is cached until its inputs change
+        render_data = DeviceRenderData(instance.device)
+        # Profiling requires an actual render, so bypasses the cache
+        profiler = RenderProfiler() if request.GET.get("profile") else None
+        with profile_stage(profiler, "create context"):
+            context = make_ros_config_context(instance.device, render_data=render_data)
         config_generated, error = render_configured_device_config_for_display(
             configured_device=instance,
+            render_data=render_data,
+            use_cache=not profiler,
+            context=context,
+            profiler=profiler,
         )
         bootstrap_config, bootstrap_error = render_bootstrap_for_display(
-            device=instance.device
+            device=instance.device,
+            render_data=render_data,
+            use_cache=True,
+            context=context,
+        )
+
+        # Parsed once, then used for both the diff and for display
+        config_latest = (
+            instance.parse_last_config_fetched()
+            if instance.last_config_fetched
+            else None
         )
 
         if not error:
-            diff = instance.generate_diff()
+            diff = instance.generate_diff(
+                render_data=render_data,
+                use_cache=True,
+                config=config_generated,
+                old=config_latest,
+            )
         else:
             diff = None
 
         return {
-            **get_template_context(instance.device),
+            **get_template_context(instance.device, context=context),
             "config_generated": config_generated.__html__()
             if config_generated and config_generated.sections
             else f"<pre>{error}</pre>",
-            "config_latest": instance.parse_last_config_fetched().__html__()
-            if instance.last_config_fetched
-            else None,
+            "config_latest": config_latest.__html__() if config_latest else None,
             "config_diff": diff.__html__() if diff and diff.sections else None,
             "config_bootstrap": bootstrap_config or f"<pre>{bootstrap_error}</pre>",
+            "render_profile": profiler.as_dict() if profiler else None,
         }
 
 
@@ -157,8 +206,9 @@ class ConfigurationTemplateEditView(generic.ObjectEditView):
             configuration_template=form.instance,
         )
 
+        profiler = RenderProfiler()
         config_preview, error = render_configured_device_config_for_display(
-            configured_device=temporary_configured_device,
+            configured_device=temporary_configured_device, profiler=profiler,
         )
 
         return render(
@@ -170,6 +220,7 @@ class ConfigurationTemplateEditView(generic.ObjectEditView):
                 "form": form,
                 "return_url": self.get_return_url(request, obj),
                 "config_preview": str(config_preview) if config_preview else error,
+                "render_profile": profiler.as_dict(),
             },
         )
 
@@ -179,11 +230,15 @@ class ConfigurationTemplateView(generic.ObjectView):
     template_name = "routeros/configuration_template.html"
 
 
-def get_template_context(device: Device):
-    context = make_ros_config_context(device=device)
-    context_models = {
-        k: v for k, v in context.items() if isclass(v) and issubclass(v, Model)
-    }
+def get_template_context(
+    device: Device, render_data: DeviceRenderData = None, context: dict = None
+):
+    if context is None:
+        context = make_ros_config_context(device=device, render_data=render_data)
+    context_models = dict(template_models)
+    context_models.update(
+        {k: v for k, v in context.items() if isclass(v) and issubclass(v, Model)}
+    )
     context_functions = {
         k: v for k, v in context.items() if callable(v) and k not in context_models
     }
@@ -202,6 +257,10 @@ def get_template_context(device: Device):
 
 def render_configured_device_config_for_display(
     configured_device: ConfiguredDevice,
+    render_data: DeviceRenderData = None,
+    use_cache=False,
+    context: dict = None,
+    profiler: RenderProfiler = None,
 ) -> Tuple[Optional[RouterOSConfig], Optional[str]]:
     """Render a config for display to a user
 
@@ -210,7 +269,12 @@ def render_configured_device_config_for_display(
     error = None
     config = None
     try:
-        config = configured_device.generate_config()
+        config = configured_device.generate_config(
+            render_data=render_data,
+            use_cache=use_cache,
+            context=context,
+            profiler=profiler,
+        )
     except Exception:
         error = traceback.format_exc()
 
@@ -219,11 +283,34 @@ def render_configured_device_config_for_display(
 
 def render_bootstrap_for_display(
     device: Device,
+    render_data: DeviceRenderData = None,
+    use_cache=False,
+    context: dict = None,
 ) -> Tuple[Optional[str], Optional[str]]:
     error = None
     config = None
+    render_data = render_data or DeviceRenderData(device)
     try:
-        config = render_ros_config(device=device, template_name="bootstrap")
+        content = get_template_source("bootstrap")
+        render = lambda: render_ros_config(
+            device=device,
+            template_name="bootstrap",
+            template_content=content,
+            render_data=render_data,
+            context=context,
+        )
+        if use_cache:
+            config = get_or_compute(
+                [
+                    "bootstrap",
+                    content,
+                    get_templates_version(),
+                    render_data.fingerprint(),
+                ],
+                render,
+            )
+        else:
+            config = render()
     except TemplateNotFound:
         # Just return None
         pass
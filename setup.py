@@ -32,6 +32,8 @@ setup(
     license="MIT",
     packages=[
         "netbox_routeros",
+        "netbox_routeros.management",
+        "netbox_routeros.management.commands",
         "netbox_routeros.migrations",
         "netbox_routeros.tests",
         "netbox_routeros.utilities",
@@ -42,6 +44,7 @@ setup(
             "static/netbox_routeros/*.css",
             "templates/routeros/*.html",
             "templates/routeros/bases/*.html",
+            "templates/routeros/inc/*.html",
         ]
     },
     install_requires=["jinja2==2.*,>=2.11.3"],